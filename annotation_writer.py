@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+AnnotationWriter
+
+Appends per-image annotation records to JSON Lines segments in constant time,
+and consolidates them into the final annotations.json in a single pass. The
+records already consolidated by an interrupted run are kept, so that it can be
+resumed.
+"""
+
+import argparse
+import shutil
+import json
+import os
+
+
+CLASSES = [
+    {'id': 0, 'label': 'Background'},
+    {'id': 1, 'label': 'Closest gate'},
+    {'id': 2, 'label': 'Backward gate'},
+    {'id': 3, 'label': 'Forward gate'}
+]
+
+
+class AnnotationWriter:
+    segments_dir_name = 'annotations.segments'
+    segment_name = "segment_%06d.jsonl"
+
+    def __init__(self, path: str, batch_size=256, segment_size=10000):
+        self.path = path
+        self.segments_dir = os.path.join(path, self.segments_dir_name)
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.buffer = []
+        self.segment = None
+        self.segment_no = 0
+        self.segment_count = 0
+
+    '''
+    Starts a new set of segments. A new run overwrites whatever a previous one
+    left behind (including its annotations.json), while a resumed one appends
+    new segments to them.
+    '''
+    def open(self, resume=False):
+        annotations_path = os.path.join(self.path, 'annotations.json')
+        if not resume and os.path.isfile(annotations_path):
+            os.remove(annotations_path)
+        if os.path.isdir(self.segments_dir):
+            if not resume:
+                shutil.rmtree(self.segments_dir)
+            else:
+                self.segment_no = len(os.listdir(self.segments_dir))
+                return
+        os.mkdir(self.segments_dir)
+
+    def append(self, record):
+        self.buffer.append(json.dumps(record, ensure_ascii=False))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    '''
+    Writes the buffered records to the current segment and syncs it to disk,
+    so that a crash can only ever lose the records of the current batch.
+    '''
+    def flush(self):
+        while self.buffer:
+            if self.segment is None:
+                self.segment = open(
+                    os.path.join(self.segments_dir,
+                                 self.segment_name % self.segment_no),
+                    'a', encoding='UTF-8')
+            n = min(len(self.buffer), self.segment_size - self.segment_count)
+            self.segment.write(''.join(line + '\n'
+                                       for line in self.buffer[:n]))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            del self.buffer[:n]
+            self.segment_count += n
+            if self.segment_count >= self.segment_size:
+                self.segment.close()
+                self.segment = None
+                self.segment_no += 1
+                self.segment_count = 0
+
+    def close(self):
+        self.flush()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        self.consolidate(self.path)
+
+    '''
+    Yields every complete record found in the segments directory. A truncated
+    trailing line (interrupted write) is skipped.
+    '''
+    @classmethod
+    def read_segments(cls, segments_dir: str):
+        if not os.path.isdir(segments_dir):
+            return
+        for segment in sorted(os.listdir(segments_dir)):
+            with open(os.path.join(segments_dir, segment),
+                      'r', encoding='UTF-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        break
+
+    '''
+    Merges all the segments into annotations.json, sorted by image name, along
+    with the records it already holds (consolidated before an interruption).
+    The file is written to a temporary path first and atomically moved in
+    place.
+    '''
+    @classmethod
+    def consolidate(cls, path: str):
+        segments_dir = os.path.join(path, cls.segments_dir_name)
+        annotations_path = os.path.join(path, 'annotations.json')
+        records = {}
+        if os.path.isfile(annotations_path):
+            with open(annotations_path, 'r', encoding='UTF-8') as f:
+                for record in json.load(f)['annotations']:
+                    records[record['image']] = record
+        for record in cls.read_segments(segments_dir):
+            records[record['image']] = record
+
+        annotations = {}
+        annotations['classes'] = CLASSES
+        annotations['annotations'] = [records[name]
+                                      for name in sorted(records)]
+        tmp_path = os.path.join(path, 'annotations.json.tmp')
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump(annotations, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, annotations_path)
+        if os.path.isdir(segments_dir):
+            shutil.rmtree(segments_dir)
+
+        return len(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Consolidate the annotation segments left behind by an \
+        interrupted run into annotations.json')
+    parser.add_argument('destination', metavar='dest', help='the path\
+                        to the generated dataset', type=str)
+    args = parser.parse_args()
+    print("[*] Consolidated {} annotations".format(
+        AnnotationWriter.consolidate(args.destination)))
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+BackgroundIndex
+
+Columnar index of the annotated background images of a dataset: a NumPy
+structured array of their file names, translations and orientations, built
+once from annotations.csv (with a vectorized reader) and saved alongside it,
+to be memory-mapped by the following runs rather than parsed again.
+"""
+
+import numpy as np
+import argparse
+import json
+import os
+
+
+'''
+Reads the (file name, translation, orientation) columns of an annotations
+CSV file as a structured array. The lines are only split in vectorized NumPy
+operations.
+'''
+def read_annotations_csv(path: str):
+    with open(path, 'rb') as f:
+        f.readline() # Discard the header
+        lines = np.array(f.read().splitlines(), dtype=np.bytes_)
+    lines = lines[np.char.strip(lines) != b'']
+    if len(lines) == 0:
+        return np.empty(0, dtype=index_dtype(1))
+    names, _, rest = np.char.partition(lines, b',').T
+    # The following columns (e.g. the timestamp) may not be numbers
+    values = np.empty((len(lines), 7))
+    try:
+        for column in range(7):
+            field, _, rest = np.char.partition(rest, b',').T
+            values[:, column] = field.astype(np.float64)
+    except ValueError as e:
+        raise Exception("Malformed annotations file {}: {}".format(path, e))
+    names = np.char.strip(names)
+    index = np.empty(len(lines), dtype=index_dtype(names.dtype.itemsize))
+    index['file'] = names
+    index['translation'] = values[:, 0:3]
+    index['orientation'] = values[:, 3:7]
+
+    return index
+
+
+def index_dtype(name_size: int):
+    return np.dtype([
+        ('file', 'S{}'.format(max(1, name_size))),
+        ('translation', 'f8', 3),
+        ('orientation', 'f8', 4)
+    ])
+
+
+class BackgroundIndex:
+    file_name = 'background_index.npy'
+    meta_name = 'background_index.json'
+
+    def __init__(self, path: str, annotations_path=None):
+        self.path = path
+        self.annotations_path = annotations_path or os.path.join(
+            path, 'annotations.csv')
+
+    '''
+    Returns the memory-mapped index, (re)building it first if annotations.csv
+    or the images of the directory changed since it was built
+    '''
+    def load(self):
+        if not os.path.isfile(self.annotations_path):
+            raise Exception("Annotations file not found")
+        index_path = os.path.join(self.path, self.file_name)
+        meta_path = os.path.join(self.path, self.meta_name)
+        if os.path.isfile(index_path) and os.path.isfile(meta_path):
+            with open(meta_path, 'r', encoding='UTF-8') as f:
+                if json.load(f).get('annotations') == self.key():
+                    return np.load(index_path, mmap_mode='r')
+
+        index = self.build()
+        try:
+            # Adding the sidecars to the directory changes its mtime, but
+            # rewriting the metadata in place doesn't: the key is taken after
+            if not os.path.isfile(meta_path):
+                open(meta_path, 'w').close()
+            np.save(index_path + '.tmp.npy', index)
+            os.replace(index_path + '.tmp.npy', index_path)
+            with open(meta_path, 'w', encoding='UTF-8') as f:
+                json.dump({'annotations': self.key(),
+                           'backgrounds': len(index)}, f)
+        except OSError as e:
+            print("[!] Could not save the background index: {}".format(e))
+            return index
+
+        return np.load(index_path, mmap_mode='r')
+
+    '''
+    Key of the index: the size and mtime of annotations.csv, and the mtime of
+    the directory (which changes when images are added or removed)
+    '''
+    def key(self):
+        stat = os.stat(self.annotations_path)
+        return [stat.st_size, stat.st_mtime_ns,
+                os.stat(self.path).st_mtime_ns]
+
+    '''
+    Indexes the annotated images of the dataset, listing its directory once
+    '''
+    def build(self):
+        print("[*] Indexing the background annotations of {}...".format(
+            self.path))
+        index = read_annotations_csv(self.annotations_path)
+        files = np.array([os.fsencode(file) for file in os.listdir(self.path)])
+        # Keep the last line of each image, and remove the annotations without
+        # images
+        _, last = np.unique(index['file'][::-1], return_index=True)
+        index = index[np.sort(len(index) - 1 - last)]
+
+        return index[np.isin(index['file'], files)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Build the background index of a dataset ahead of time')
+    parser.add_argument('dataset', help='the path to the background images \
+                        dataset', type=str)
+    args = parser.parse_args()
+    print("[*] Indexed {} backgrounds".format(
+        len(BackgroundIndex(args.dataset).load())))
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+BackgroundPrefetcher
+
+Decodes the upcoming background images ahead of the renderer, in a small
+thread pool, so that each one is decoded exactly once and off the critical
+path.
+"""
+
+import numpy as np
+
+from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from profiler import Profiler
+
+
+'''
+Decodes an image file to an RGB uint8 array of shape (height, width, 3)
+'''
+def decode_image(path: str):
+    with Image.open(path) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+class BackgroundPrefetcher:
+    def __init__(self, dataset, indices, max_bytes=256*1024**2, workers=2,
+                 profiler=None):
+        self.dataset = dataset
+        self.indices = indices
+        self.workers = workers
+        self.profiler = profiler or Profiler()
+        # Decoded frames in flight are bounded by their size: the lookahead
+        # is as deep as the memory budget allows
+        frame_bytes = dataset.width * dataset.height * 3
+        self.depth = max(1, max_bytes // frame_bytes)
+
+    '''
+    Yields (index, BackgroundImage, decoded image) tuples, in the order of
+    the given indices. The indices are consumed lazily, at most depth ahead
+    of the caller.
+    '''
+    def __iter__(self):
+        pending = deque()
+        indices = iter(self.indices)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                while len(pending) < self.depth:
+                    index = next(indices, None)
+                    if index is None:
+                        break
+                    with self.profiler.span('dataset_get', index=index):
+                        background = self.dataset.get(index)
+                    pending.append((index, background, executor.submit(
+                        self.decode, index, background.file)))
+                if len(pending) == 0:
+                    break
+                index, background, image = pending.popleft()
+                with self.profiler.span('queue_empty:prefetch', index=index):
+                    image = image.result()
+                yield index, background, image
+        finally:
+            for _, _, image in pending:
+                image.cancel()
+            executor.shutdown(wait=True)
+
+    def decode(self, index, path: str):
+        with self.profiler.span('decode', index=index):
+            return decode_image(path)
@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+BackgroundSampler
+
+Lazily maps sample indices to rows of the background index, without
+materializing a pick per sample: either in epochs (each background is used
+once per epoch, in a new order every epoch), or with replacement (optionally
+weighted per background), in blocks of picks drawn on demand. Each epoch or
+block has its own generator, derived from the seed, so that any process can
+look up any sample.
+"""
+
+import numpy as np
+import hashlib
+import os
+
+
+'''
+Seed of an independent generator, derived from the run's seed and a key (e.g.
+a sample index)
+'''
+def derive_seed(seed, key):
+    digest = hashlib.sha256("{}:{}".format(seed, key).encode('UTF-8'))
+    return np.frombuffer(digest.digest(), dtype=np.uint32)
+
+
+'''
+Reads a CSV file of (file name, weight) lines (after a header), and returns
+the weight of each row of the given background index. Backgrounds which are
+not listed weigh 1.
+'''
+def read_weights(path: str, index):
+    if not os.path.isfile(path):
+        raise Exception("Weights file {} not found".format(path))
+    with open(path, 'rb') as f:
+        f.readline() # Discard the header
+        lines = np.array(f.read().splitlines(), dtype=np.bytes_)
+    lines = lines[np.char.strip(lines) != b'']
+    weights = np.ones(len(index))
+    if len(lines) == 0:
+        return weights
+    names, _, rest = np.char.partition(lines, b',').T
+    names = np.char.strip(names)
+    try:
+        values = np.char.partition(rest, b',')[:, 0].astype(np.float64)
+    except ValueError as e:
+        raise Exception("Malformed weights file {}: {}".format(path, e))
+    # Match the listed names with the rows of the index
+    order = np.argsort(index['file'])
+    positions = np.searchsorted(index['file'], names, sorter=order)
+    positions = np.minimum(positions, len(index) - 1)
+    found = index['file'][order[positions]] == names
+    weights[order[positions[found]]] = values[found]
+
+    return weights
+
+
+class BackgroundSampler:
+    def __init__(self, size: int, seed, replacement=False, weights=None,
+                 shuffle=True, block_size=4096):
+        if size == 0:
+            raise Exception("No background to sample from")
+        self.size = size
+        self.seed = seed
+        self.replacement = replacement
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.cdf = None
+        if weights is not None:
+            if not replacement:
+                raise Exception("Weighted sampling requires sampling with "
+                                "replacement")
+            if np.any(weights < 0) or weights.sum() <= 0:
+                raise Exception("The weights must be positive")
+            self.cdf = np.cumsum(weights, dtype=np.float64)
+            self.cdf /= self.cdf[-1]
+        # The picks of the last epoch or block looked up
+        self.cached = (None, None)
+
+    '''
+    Returns the row of the background of the given sample
+    '''
+    def __getitem__(self, index: int):
+        if self.replacement:
+            key, position = divmod(index, self.block_size)
+            picks = self.picks(key, self.block)
+        else:
+            key, position = divmod(index, self.size)
+            picks = self.picks(key, self.epoch)
+
+        return int(picks[position])
+
+    def picks(self, key: int, draw):
+        cached_key, picks = self.cached
+        if cached_key != key:
+            picks = draw(key)
+            self.cached = (key, picks)
+
+        return picks
+
+    '''
+    Order of the backgrounds during the given epoch
+    '''
+    def epoch(self, epoch: int):
+        if not self.shuffle:
+            return np.arange(self.size, dtype=np.uint32)
+        rng = np.random.RandomState(derive_seed(
+            self.seed, 'backgrounds:epoch:{}'.format(epoch)))
+
+        return rng.permutation(self.size).astype(np.uint32)
+
+    '''
+    Backgrounds of the given block of samples, drawn with replacement
+    '''
+    def block(self, block: int):
+        rng = np.random.RandomState(derive_seed(
+            self.seed, 'backgrounds:block:{}'.format(block)))
+        if self.cdf is None:
+            return rng.randint(self.size, size=self.block_size)
+        picks = np.searchsorted(self.cdf, rng.random_sample(self.block_size),
+                                side='right')
+
+        return np.minimum(picks, self.size - 1)
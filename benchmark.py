@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Benchmark
+
+Times each stage of the generation of a sample (background decoding,
+rendering, readback, blur estimation, blur, noise, compositing, encoding and
+annotation writing) on a synthetic background dataset, with the bundled
+meshes and camera parameters, and reports their latency percentiles and
+throughput as JSON.
+"""
+
+import numpy as np
+import contextlib
+import platform
+import tempfile
+import argparse
+import shutil
+import json
+import math
+import time
+import cv2
+import sys
+import os
+
+from collections import OrderedDict
+from PIL import Image
+from dataset import AnnotatedImage, SyntheticAnnotations
+from background_prefetcher import decode_image
+from annotation_writer import AnnotationWriter
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['background_decode', 'render', 'readback', 'blur_estimate', 'blur',
+          'noise', 'composite', 'encode', 'annotation_write', 'total']
+
+
+'''
+Creates a background dataset of count blocky random images (so that they have
+some texture for the blur estimation) along with its annotations.csv, with
+random drone poses inside the world boundaries.
+'''
+def make_fixture(path: str, count: int, width: int, height: int, seed=0):
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'annotations.csv'), 'w') as f:
+        f.write("frame,translation_x,translation_y,translation_z,rotation_x,"
+                "rotation_y,rotation_z,rotation_w,timestamp\n")
+        for i in range(count):
+            blocks = rng.randint(0, 256, (height // 8 + 1, width // 8 + 1, 3),
+                                 dtype=np.uint8)
+            img = cv2.resize(blocks, (width, height),
+                             interpolation=cv2.INTER_NEAREST)
+            name = "%06d.jpg" % i
+            Image.fromarray(img).save(os.path.join(path, name), quality=90)
+            yaw = rng.uniform(-math.pi, math.pi)
+            f.write("{},{},{},{},0,0,{},{},{}\n".format(
+                name, rng.uniform(-4, 4), rng.uniform(-4, 4),
+                rng.uniform(1, 2), math.sin(yaw / 2), math.cos(yaw / 2), i))
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = OrderedDict((stage, []) for stage in STAGES)
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        yield
+        if self.enabled:
+            self.timings[name].append(time.perf_counter() - start)
+
+    '''
+    Latency percentiles (in milliseconds) and throughput of each stage
+    '''
+    def summary(self):
+        summary = OrderedDict()
+        for stage, timings in self.timings.items():
+            if len(timings) == 0:
+                continue
+            timings = np.array(timings) * 1000
+            summary[stage] = OrderedDict([
+                ('count', len(timings)),
+                ('mean_ms', float(timings.mean())),
+                ('p50_ms', float(np.percentile(timings, 50))),
+                ('p90_ms', float(np.percentile(timings, 90))),
+                ('p99_ms', float(np.percentile(timings, 99))),
+                ('max_ms', float(timings.max())),
+                ('per_second', float(1000 / timings.mean()))
+            ])
+
+        return summary
+
+
+def run(args, fixture: str, destination: str):
+    # Imported here, for LIBGL_ALWAYS_SOFTWARE to be set before any context
+    from dataset_factory import DatasetFactory, parse_args
+
+    total = args.warmup + args.count
+    factory_args = [
+        os.path.join(ROOT, 'meshes'), fixture, destination, '--camera',
+        os.path.join(ROOT, 'data', 'camera_calibration_params.yaml'),
+        '--count', str(total), '--res', args.resolution, '--seed', '0',
+        '--format', args.image_format, '--gl-backend', args.gl_backend, '-t',
+        '1']
+    if args.gpu_post:
+        factory_args.append('--gpu-post')
+    factory = DatasetFactory(parse_args(factory_args))
+    factory.set_world_parameters({'x': 10, 'y': 10})
+    projector = factory.create_projector()
+    dataset = factory.generated_dataset
+    encoder = dataset.encoder
+    writer = AnnotationWriter(destination)
+    writer.open()
+
+    timer = StageTimer()
+    for index in range(total):
+        timer.enabled = index >= args.warmup
+        with timer.stage('total'):
+            background = factory.background_dataset.get(index)
+            with timer.stage('background_decode'):
+                image = decode_image(background.file)
+            rng = factory.sample_rng(index)
+            projector.set_drone_pose(background.annotations)
+            blur_amount, noise_amount = None, 0.0
+            if factory.gpu_post:
+                with timer.stage('blur_estimate'):
+                    blur_amount = factory.get_blur_amount(background, image)
+                noise_amount = factory.noise_amount
+            with timer.stage('render'):
+                annotations = projector.render(factory.min_dist,
+                                               factory.max_gates, rng,
+                                               blur_amount, noise_amount)
+                projector.context.finish()
+            with timer.stage('readback'):
+                projection = projector.read_frame()
+            bboxes = annotations['bboxes']
+            if len(bboxes) > 0 and not factory.gpu_post:
+                with timer.stage('blur_estimate'):
+                    blur_amount = factory.get_blur_amount(background, image)
+                with timer.stage('blur'):
+                    projection = factory.apply_motion_blur(projection,
+                                                           blur_amount)
+                with timer.stage('noise'):
+                    projection = factory.add_noise(projection, rng)
+            with timer.stage('composite'):
+                output = factory.combine(projection, image)
+            with timer.stage('encode'):
+                encoder.encode(output)
+            with timer.stage('annotation_write'):
+                writer.append(dataset.annotation_record(
+                    AnnotatedImage(output, index,
+                                   SyntheticAnnotations(bboxes)),
+                    "%06d" % index + encoder.extension))
+    writer.close()
+    renderer = projector.context.info['GL_RENDERER']
+    projector.destroy()
+
+    return OrderedDict([
+        ('config', OrderedDict([
+            ('count', args.count),
+            ('warmup', args.warmup),
+            ('fixture_resolution', args.fixture_resolution),
+            ('resolution', args.resolution),
+            ('format', args.image_format),
+            ('gpu_post', args.gpu_post),
+            ('gl_backend', args.gl_backend),
+            ('software_gl', not args.hardware)
+        ])),
+        ('environment', OrderedDict([
+            ('gl_renderer', renderer),
+            ('python', platform.python_version()),
+            ('numpy', np.__version__),
+            ('opencv', cv2.__version__),
+            ('cpus', os.cpu_count())
+        ])),
+        ('stages', timer.summary())
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage of the generation of a sample on a \
+        synthetic background dataset, and output the results as JSON.')
+    parser.add_argument('--count', dest='count', default=100, type=int,
+                        help='the number of samples to time')
+    parser.add_argument('--warmup', dest='warmup', default=5, type=int,
+                        help='the number of samples generated before timing')
+    parser.add_argument('--fixture-res', dest='fixture_resolution',
+                        default='640x480', type=str, help='the resolution of\
+                        the synthetic background images (WxH)')
+    parser.add_argument('--res', dest='resolution', default='640x480',
+                        type=str, help='the output resolution (WxH)')
+    parser.add_argument('--fixture', dest='fixture', default=None, type=str,
+                        help='where to create (or reuse) the synthetic\
+                        background dataset (a temporary directory by\
+                        default)')
+    parser.add_argument('--format', dest='image_format', default='png',
+                        type=str, help='the output image format')
+    parser.add_argument('--gpu-post', dest='gpu_post', action='store_true',
+                        default=False, help='apply the motion blur and noise\
+                        on the GPU')
+    parser.add_argument('--gl-backend', dest='gl_backend', default='egl',
+                        type=str, help='the OpenGL context backend')
+    parser.add_argument('--hardware', dest='hardware', action='store_true',
+                        default=False, help='use the hardware OpenGL driver\
+                        rather than the software one')
+    parser.add_argument('-o', dest='output', default=None, type=str,
+                        help='the path of the JSON results (printed by\
+                        default)')
+    args = parser.parse_args()
+
+    if not args.hardware:
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    width, height = [int(x) for x in args.fixture_resolution.split('x')]
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        fixture = args.fixture or os.path.join(tmp_dir, 'backgrounds')
+        if not os.path.isfile(os.path.join(fixture, 'annotations.csv')):
+            print("[*] Creating {} synthetic backgrounds...".format(
+                args.warmup + args.count), file=sys.stderr)
+            make_fixture(fixture, args.warmup + args.count, width, height)
+        destination = os.path.join(tmp_dir, 'output')
+        os.mkdir(destination)
+        # Keep the standard output for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(args, fixture, destination)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("[*] Saved to {}".format(args.output), file=sys.stderr)
+    else:
+        print(json.dumps(results, indent=4))
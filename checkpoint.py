@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Checkpoint
+
+Keeps track of the chunks of samples which are durably written, along with
+the parameters of the run (including its seed, from which every sample's RNG
+state is derived), so that an interrupted run can be resumed.
+
+Since the chunks complete almost in order, the state is kept compact: the
+number of chunks below which every chunk is complete, and the few completed
+chunks above it. Saving it thus takes constant time however long the run.
+"""
+
+import json
+import os
+
+
+class Checkpoint:
+    file_name = 'checkpoint.json'
+
+    def __init__(self, path: str, config, count: int, chunk_size: int,
+                 interval=64):
+        self.path = path
+        self.config = config
+        self.count = count
+        self.chunk_size = chunk_size
+        self.interval = interval
+        # Every chunk below contiguous is complete, along with those in
+        # completed (which are all above it)
+        self.contiguous = 0
+        self.completed = set()
+        # Number of records written per chunk, not durable yet
+        self.written = {}
+        self.unsaved = 0
+
+    '''
+    Returns the state of the checkpoint found in the given directory, if any
+    '''
+    @classmethod
+    def read(cls, path: str):
+        checkpoint_path = os.path.join(path, cls.file_name)
+        if not os.path.isfile(checkpoint_path):
+            return None
+        with open(checkpoint_path, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+
+    '''
+    Restores the completed chunks of a previous run, which must have been
+    started with the same parameters.
+    '''
+    def resume(self, state):
+        for key, val in self.config.items():
+            if state['config'].get(key) != val:
+                raise Exception("Cannot resume: the run was started with {}={}"
+                                " (got {})".format(key, state['config'].get(
+                                    key), val))
+        self.contiguous = state.get('contiguous', 0)
+        self.completed = set()
+        for chunk in state['completed']:
+            self.complete(chunk)
+
+    '''
+    Marks a chunk as completed, and advances the contiguous prefix over the
+    completed chunks which follow it
+    '''
+    def complete(self, chunk: int):
+        if chunk >= self.contiguous:
+            self.completed.add(chunk)
+        while self.contiguous in self.completed:
+            self.completed.remove(self.contiguous)
+            self.contiguous += 1
+
+    def chunk_length(self, chunk: int):
+        return min(self.chunk_size, self.count - chunk * self.chunk_size)
+
+    '''
+    Returns the (start, stop) index ranges of the chunks left to generate
+    '''
+    def chunks(self):
+        return [(start, min(start + self.chunk_size, self.count))
+                for start in range(self.contiguous * self.chunk_size,
+                                   self.count, self.chunk_size)
+                if start // self.chunk_size not in self.completed]
+
+    '''
+    Counts a written sample. Returns True when the checkpoint is due to be
+    saved (once the writer has been flushed).
+    '''
+    def add(self, index: int):
+        chunk = index // self.chunk_size
+        self.written[chunk] = self.written.get(chunk, 0) + 1
+        self.unsaved += 1
+
+        return self.unsaved >= self.interval
+
+    '''
+    Marks the fully written chunks as completed, and atomically saves the
+    checkpoint. Must only be called once the written samples are flushed.
+    '''
+    def save(self):
+        for chunk, written in list(self.written.items()):
+            if written >= self.chunk_length(chunk):
+                self.complete(chunk)
+                del self.written[chunk]
+        self.unsaved = 0
+        checkpoint_path = os.path.join(self.path, self.file_name)
+        with open(checkpoint_path + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump({
+                'config': self.config,
+                'contiguous': self.contiguous,
+                'completed': sorted(self.completed)
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
@@ -0,0 +1,27 @@
+#version 330
+
+uniform mat4 VP;
+
+in vec3 in_vert;
+in vec3 in_norm;
+in vec2 in_text;
+
+// Per-instance attributes
+in mat4 in_model;
+in vec3 in_color;
+in vec3 in_light;
+
+out vec3 v_vert;
+out vec3 v_norm;
+out vec2 v_text;
+flat out vec3 v_color;
+flat out vec3 v_light;
+
+void main() {
+	gl_Position = VP * in_model * vec4(in_vert, 1.0);
+	v_vert = in_vert;
+	v_norm = in_norm;
+	v_text = in_text;
+	v_color = in_color;
+	v_light = in_light;
+}
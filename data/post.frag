@@ -0,0 +1,60 @@
+#version 330
+
+uniform sampler2D Texture;
+// Size of the diagonal motion blur kernel (1 disables the blur)
+uniform int KernelSize;
+// Standard deviation of the gaussian noise, in 8-bit levels (0 disables it)
+uniform float NoiseStddev;
+uniform uint NoiseSeed;
+
+out vec4 f_color;
+
+// Mirrors out of bounds coordinates like OpenCV's BORDER_REFLECT_101
+ivec2 reflect101(ivec2 p, ivec2 size) {
+	p = abs(p);
+	return min(p, 2 * size - 2 - p);
+}
+
+uint hash(uint x) {
+	x ^= x >> 16;
+	x *= 0x7feb352du;
+	x ^= x >> 15;
+	x *= 0x846ca68bu;
+	x ^= x >> 16;
+	return x;
+}
+
+float uniform01(inout uint state) {
+	state = hash(state);
+	return (float(state >> 8) + 0.5) / 16777216.0;
+}
+
+// Two independent standard normal samples (Box-Muller)
+vec2 gaussian(inout uint state) {
+	float r = sqrt(-2.0 * log(uniform01(state)));
+	float theta = 6.28318530718 * uniform01(state);
+	return r * vec2(cos(theta), sin(theta));
+}
+
+void main() {
+	ivec2 size = textureSize(Texture, 0);
+	ivec2 p = ivec2(gl_FragCoord.xy);
+
+	// Rows are stored top-down (the frame is rendered upside down): the
+	// top-left to bottom-right diagonal of the image goes along (+1, +1)
+	vec4 color = vec4(0.0);
+	for (int i = 0; i < KernelSize; i++) {
+		int d = i - KernelSize / 2;
+		color += texelFetch(Texture, reflect101(p + ivec2(d, d), size), 0);
+	}
+	// Quantized like the 8-bit render target, then noised with truncation
+	color = floor(color * 255.0 / float(KernelSize) + 0.5);
+
+	if (NoiseStddev > 0.0) {
+		uint state = hash(NoiseSeed ^ hash(uint(p.x) + uint(p.y) * 65536u));
+		color = floor(color + NoiseStddev * vec4(gaussian(state),
+			gaussian(state)));
+	}
+
+	f_color = clamp(color, 0.0, 255.0) / 255.0;
+}
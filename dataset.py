@@ -10,15 +10,40 @@
 Dataset class, holding background images along with their annotations
 """
 
+import numpy as np
 import random
-import json
+import math
 import os
 
 from PIL import Image
 from tqdm import tqdm
-from queue import Queue
 from threading import Thread
+from collections import deque
 from pyrr import Vector3, Quaternion
+from annotation_writer import AnnotationWriter
+from background_index import BackgroundIndex
+from background_sampler import BackgroundSampler, read_weights
+from shard_writer import ShardWriter, sample_id
+from image_encoder import ImageEncoder, sync_path
+from memory_budget import ByteQueue
+from profiler import Profiler
+
+
+'''
+In-memory annotations of a batch of samples: one row per bounding box, with
+the position of its sample in the batch. The fields are those of the
+annotation records (the distance is NaN for the gates seen from the back).
+'''
+ANNOTATION_DTYPE = np.dtype([
+    ('sample', 'i4'),
+    ('class_id', 'i4'),
+    ('xmin', 'i4'),
+    ('ymin', 'i4'),
+    ('xmax', 'i4'),
+    ('ymax', 'i4'),
+    ('distance', 'f8'),
+    ('rotation', 'f8')
+])
 
 
 class BackgroundAnnotations:
@@ -48,132 +73,223 @@ class SyntheticAnnotations:
 Holds a generated image along with its annotations
 '''
 class AnnotatedImage:
-    def __init__(self, image: Image, id, annotations: SyntheticAnnotations):
+    def __init__(self, image: np.ndarray, id,
+                 annotations: SyntheticAnnotations):
         self.image = image
         self.id = id
         self.annotations = annotations
 
 
 class Dataset:
-    def __init__(self, path: str, seed=None, max=0):
+    def __init__(self, path: str, seed=None, max_bytes=0):
         if not os.path.isdir(path):
             raise Exception("Dataset directory {} not found".format(path))
-        if seed:
-            random.seed(seed)
-        else:
-            random.seed()
+        # Seed of the order of the backgrounds
+        self.seed = seed
+        if self.seed is None:
+            self.seed = "%016x" % random.SystemRandom().getrandbits(64)
         self.path = path
         self.width = None
         self.height = None
-        self.data = Queue(maxsize=max)
+        # Generated images waiting to be saved, bounded by their size
+        self.data = ByteQueue(max_bytes)
+        # The (memory-mapped) background index, and the sampler picking the
+        # row of each sample in it
+        self.index = None
+        self.sampler = None
         self.saving = False
+        self.encoder = None
+        # Samples per shard, or 0 to write an images directory
+        self.shard_size = 0
+        self.checkpoint = None
+        self.resume = False
+        # Images written since the last checkpoint, to sync before saving it
+        self.unsynced = []
+        self.profiler = Profiler()
 
-    def parse_annotations(self, path: str):
-        if not os.path.isfile(path):
-            raise Exception("Annotations file not found")
-        annotations = dict()
-        with open(path) as file:
-            file.readline() # Discard the header
-            for line in file:
-                items = line.split(',')
-                annotations[items[0].strip()] = BackgroundAnnotations(
-                    Vector3([float(x) for x in items[1:4]]),
-                    Quaternion([float(x) for x in items[4:8]])
-                )
+    '''
+    Loads the background index, and samples it either in epochs (the default)
+    or with replacement, optionally weighted by the (file name, weight) CSV
+    file at weights_path.
+    '''
+    def load(self, annotations_path=None, randomize=True, replacement=False,
+             weights_path=None):
+        print("[*] Loading the base dataset...")
+        self.index = BackgroundIndex(self.path, annotations_path).load()
+        if len(self.index) == 0:
+            return False
+        weights = None
+        if weights_path is not None:
+            weights = read_weights(weights_path, self.index)
+        self.sampler = BackgroundSampler(len(self.index), self.seed,
+                                         replacement=replacement,
+                                         weights=weights, shuffle=randomize)
+        with Image.open(self.get(0).file) as img:
+            self.width, self.height = img.size
 
-        return annotations
+        return True
 
-    def load(self, count, annotations_path=None, randomize=True):
-        print("[*] Loading and randomizing base dataset...")
-        if randomize:
-            files = os.listdir(self.path)
-            random.shuffle(files)
-        else:
-            file = sorted(os.listdir(self.path))
-
-        annotations = self.parse_annotations(annotations_path)
-        # Remove files without annotations
-        files = [file for file in files if file in annotations]
-        while count > len(files):
-            choice = random.choice(files)
-            full_path = os.path.join(self.path, choice)
-            if os.path.isfile(full_path) and full_path != annotations_path:
-                files += [choice]
-
-        for file in files:
-            full_path = os.path.join(self.path, file)
-            if os.path.isfile(full_path) and full_path != annotations_path:
-                self.data.put(BackgroundImage(full_path, annotations[file]))
-                self.data.task_done()
-                if not self.width and not self.height:
-                    with Image.open(full_path) as img:
-                        self.width, self.height = img.size
-
-        self.data.join()
-        return self.data.qsize() != 0
-
-    '''
-    Returns the next BackgroundImage in the Queue
-    '''
-    def get(self):
-        return self.data.get()
+    '''
+    Returns the BackgroundImage for the given sample index. Indexing (rather
+    than popping from a queue) lets any worker process generate any sample.
+    '''
+    def get(self, index):
+        background = self.index[self.sampler[index]]
+        return BackgroundImage(
+            os.path.join(self.path, background['file'].decode('UTF-8')),
+            BackgroundAnnotations(Vector3(background['translation']),
+                                  Quaternion(background['orientation'])))
 
     def task_done(self):
         self.data.task_done()
 
     def put(self, image: AnnotatedImage):
-        self.data.put(image)
+        with self.profiler.span('queue_full:saver', index=image.id):
+            self.data.put(image, image.image.nbytes)
+
+    '''
+    Yields the images put in the queue, until None is put
+    '''
+    def pending(self):
+        while True:
+            with self.profiler.span('queue_empty:saver'):
+                image = self.data.get()
+            if image is None:
+                break
+            yield image
+
+    def open(self):
+        if not self.saving:
+            if self.encoder is None:
+                self.encoder = ImageEncoder()
+            if self.shard_size > 0:
+                self.writer = ShardWriter(self.path, self.shard_size)
+            else:
+                self.writer = AnnotationWriter(self.path)
+                if not os.path.isdir(os.path.join(self.path, 'images')):
+                    os.mkdir(os.path.join(self.path, 'images'))
+            self.writer.open(self.resume)
+            if self.checkpoint is not None and not self.resume:
+                self.checkpoint.save()
+            self.saving = True
+
+    def close(self):
+        self.encoder.close()
+        self.writer.close()
+        if self.checkpoint is not None:
+            self.sync_images()
+            self.checkpoint.save()
+
+    '''
+    Hands a record over to the writer, and periodically checkpoints the
+    samples which were durably written
+    '''
+    def append(self, record):
+        id = sample_id(record['image'])
+        with self.profiler.span('save', index=id):
+            self.writer.append(record)
+            if self.shard_size == 0:
+                self.unsynced.append(record['image'])
+            if self.checkpoint is not None and self.checkpoint.add(id):
+                self.writer.flush()
+                self.sync_images()
+                self.checkpoint.save()
+
+    '''
+    Syncs the images written since the last checkpoint (and their directory)
+    to disk, only when a checkpoint is due rather than once per image
+    '''
+    def sync_images(self):
+        if self.shard_size > 0:
+            return
+        images_path = os.path.join(self.path, 'images')
+        for name in self.unsynced:
+            sync_path(os.path.join(images_path, name))
+        sync_path(images_path)
+        self.unsynced = []
 
     # Runs in a thread
     def save(self):
-        if not self.saving:
-            with open(os.path.join(self.path, 'annotations.json'),
-                      'w', encoding='UTF-8') as f:
-                annotations = {}
-                annotations['classes'] = [
-                    {'id': 0, 'label': 'Background'},
-                    {'id': 1, 'label': 'Closest gate'},
-                    {'id': 2, 'label': 'Backward gate'},
-                    {'id': 3, 'label': 'Forward gate'}
-                ]
-                annotations['annotations'] = []
-                json.dump(annotations, f, ensure_ascii=False, indent=4)
+        self.open()
+        for record in self.write_all(self.pending()):
+            self.append(record)
 
-            self.saving = True
-            if not os.path.isdir(os.path.join(self.path, 'images')):
-                os.mkdir(os.path.join(self.path, 'images'))
-
-        for annotatedImage in iter(self.data.get, None):
-            name = "%06d.png" % annotatedImage.id
-            annotatedImage.image.save(
-                os.path.join(self.path, 'images', name)
-            )
-            bboxes = []
-            for bbox in annotatedImage.annotations.bboxes:
-                bboxes.append({
-                    'class_id': bbox['class_id'],
-                    'xmin': bbox['min'][0],
-                    'ymin': bbox['min'][1],
-                    'xmax': bbox['max'][0],
-                    'ymax': bbox['max'][1],
-                    'distance': bbox['distance'],
-                    'rotation': bbox['rotation']
-                })
-
-            annotation = {
-                'image': name,
-                'annotations': bboxes
-            }
-
-            with open(os.path.join(self.path, 'annotations.json'),
-                      'r', encoding='UTF-8') as f:
-                data = json.load(f)
-
-            data['annotations'].append(annotation)
-
-            with open(os.path.join(self.path, 'annotations.json'),
-                      'w', encoding='UTF-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+        self.close()
+
+    '''
+    Writes the given images in the encoder's threads, and yields their
+    annotation records in order.
+    '''
+    def write_all(self, annotatedImages):
+        pending = deque()
+        for annotatedImage in annotatedImages:
+            pending.append(self.encoder.submit(self.write, annotatedImage))
+            if len(pending) > 2 * self.encoder.workers:
+                yield self.wait(pending.popleft())
+        while len(pending) > 0:
+            yield self.wait(pending.popleft())
+
+    def wait(self, future):
+        with self.profiler.span('queue_full:encoder'):
+            return future.result()
+
+    '''
+    Writes the image to disk and returns its annotation record. It only
+    touches its own file, so any process can call it once open() was called.
+    When writing shards, the encoded image is returned in the record instead,
+    for the writer to append it to the current shard.
+    '''
+    def write(self, annotatedImage: AnnotatedImage):
+        name = "%06d" % annotatedImage.id + self.encoder.extension
+        data = None
+        with self.profiler.span('encode', index=annotatedImage.id):
+            if self.shard_size > 0:
+                data = self.encoder.encode(annotatedImage.image).tobytes()
+            else:
+                self.encoder.write(annotatedImage.image,
+                                   os.path.join(self.path, 'images', name))
+        record = self.annotation_record(annotatedImage, name)
+        if data is not None:
+            record['data'] = data
+
+        return record
+
+    def annotation_record(self, annotatedImage: AnnotatedImage, name: str):
+        bboxes = []
+        for bbox in annotatedImage.annotations.bboxes:
+            bboxes.append({
+                'class_id': int(bbox['class_id']),
+                'xmin': int(bbox['min'][0]),
+                'ymin': int(bbox['min'][1]),
+                'xmax': int(bbox['max'][0]),
+                'ymax': int(bbox['max'][1]),
+                'distance': (None if math.isnan(bbox['distance'])
+                             else float(bbox['distance'])),
+                'rotation': float(bbox['rotation'])
+            })
+
+        return {
+            'image': name,
+            'annotations': bboxes
+        }
+
+    '''
+    Returns the annotations of a generated image as an array of
+    ANNOTATION_DTYPE, for the sample at the given position of a batch
+    '''
+    def annotation_array(self, annotatedImage: AnnotatedImage, sample: int):
+        bboxes = annotatedImage.annotations.bboxes
+        annotations = np.empty(len(bboxes), dtype=ANNOTATION_DTYPE)
+        annotations['sample'] = sample
+        annotations['class_id'] = bboxes['class_id']
+        annotations['xmin'] = bboxes['min'][:, 0]
+        annotations['ymin'] = bboxes['min'][:, 1]
+        annotations['xmax'] = bboxes['max'][:, 0]
+        annotations['ymax'] = bboxes['max'][:, 1]
+        annotations['distance'] = bboxes['distance']
+        annotations['rotation'] = bboxes['rotation']
+
+        return annotations
 
     def get_image_size(self):
         print("[*] Using {}x{} base resolution".format(self.width, self.height))
@@ -13,17 +13,28 @@ Generates a given number of images by projecting a given model in random
 positions, onto randomly selected background images from the given dataset.
 """
 
-import multiprocessing.dummy as mp
 import numpy as np
 import argparse
+import random
 import cv2
 import sys
 import os
 
 from tqdm import *
 from PIL import Image, ImageDraw
-from skimage.util import random_noise
-from scene_renderer import SceneRenderer
+from threading import Thread
+from scene_renderer import SceneRenderer, motion_blur_kernel_size
+from generation_engine import GenerationEngine
+from background_prefetcher import BackgroundPrefetcher
+from sharpness_index import SharpnessIndex
+from noise_bank import NoiseBank
+from image_encoder import ImageEncoder, FORMATS
+from checkpoint import Checkpoint
+from gate_placement import GatePlacer
+from mesh_cache import MeshCache
+from profiler import Profiler
+from background_index import BackgroundIndex
+from background_sampler import derive_seed
 from dataset import Dataset, AnnotatedImage, SyntheticAnnotations
 
 
@@ -60,6 +71,22 @@ from dataset import Dataset, AnnotatedImage, SyntheticAnnotations
 '''
 
 
+'''
+Size of an image of the given size once thumbnailed to fit in max_size, as
+computed by Pillow: only scales down, and keeps the aspect ratio
+'''
+def thumbnail_size(size, max_size):
+    x, y = size
+    if x > max_size[0]:
+        y = int(max(y * max_size[0] / x, 1))
+        x = int(max_size[0])
+    if y > max_size[1]:
+        x = int(max(x * max_size[1] / y, 1))
+        y = int(max_size[1])
+
+    return x, y
+
+
 class DatasetFactory:
     def __init__(self, args):
         self.meshes_dir = args.meshes_dir
@@ -71,184 +98,404 @@ class DatasetFactory:
         self.max_blur_amount = args.blur_threshold
         self.noise_amount = args.noise_amount
         self.no_blur = args.no_blur
-        self.seed = args.seed
+        self.gpu_post = args.gpu_post
+        self.gl_backend = args.gl_backend
         self.max_gates = args.max_gates
         self.min_dist = args.min_dist
+        # A quarter of the memory budget goes to the prefetched backgrounds
+        # (split between the processes), the rest to the generated samples
+        # waiting to be saved
+        memory_budget = args.memory_budget * 1024**2
+        self.prefetch_bytes = memory_budget // 4 // max(1, self.nb_threads)
+        self.output_bytes = memory_budget - memory_budget // 4
         if self.extra_verbose:
             self.verbose = True
-        self.background_dataset = Dataset(args.dataset, args.seed)
-        if not self.background_dataset.load(self.count,
-                                            os.path.join(args.dataset,
-                                                         'annotations.csv')):
+        self.profiler = Profiler(args.profile)
+        # Every sample derives from the seed and its index: draw one if none
+        # was given, so that the run can be reproduced or resumed
+        self.chunk_size = 16
+        self.seed = args.seed
+        checkpoint_state = None
+        if args.resume:
+            checkpoint_state = Checkpoint.read(args.destination)
+            if checkpoint_state is None:
+                print("[!] No checkpoint to resume from in {}".format(
+                    args.destination))
+                sys.exit(1)
+            if self.seed is None:
+                self.seed = checkpoint_state['config']['seed']
+        if self.seed is None:
+            self.seed = "%016x" % random.SystemRandom().getrandbits(64)
+        print("[*] Using seed {}".format(self.seed))
+        self.background_dataset = Dataset(args.dataset, self.seed)
+        if not self.background_dataset.load(
+                os.path.join(args.dataset, 'annotations.csv'),
+                replacement=args.sampling == 'replacement',
+                weights_path=args.weights):
             print("[!] Could not load dataset!")
             sys.exit(1)
-        self.generated_dataset = Dataset(args.destination, max=100)
+        self.noise_bank = NoiseBank(
+            self.noise_amount,
+            np.random.RandomState(derive_seed(self.seed, 'noise')))
+        self.sharpness_index = SharpnessIndex(args.dataset)
+        if self.sharpness_index.load():
+            print("[*] Using the background sharpness index")
+        self.generated_dataset = Dataset(args.destination,
+                                         max_bytes=self.output_bytes)
+        self.generated_dataset.encoder = ImageEncoder(
+            args.image_format, args.encoders, compression=args.compression,
+            quality=args.quality)
+        self.generated_dataset.shard_size = args.shard_size
+        self.generated_dataset.profiler = self.profiler
+        self.checkpoint = Checkpoint(args.destination, {
+            key: getattr(args, key) for key in [
+                'meshes_dir', 'dataset', 'nb_images', 'resolution',
+                'camera_parameters', 'verbose', 'extra_verbose',
+                'blur_threshold', 'noise_amount', 'no_blur', 'gpu_post',
+                'render_at_target', 'image_format', 'compression', 'quality',
+                'shard_size', 'max_gates', 'min_dist', 'sampling', 'weights']
+        }, self.count, self.chunk_size)
+        self.checkpoint.config['seed'] = self.seed
+        self.checkpoint.config['chunk_size'] = self.chunk_size
+        if checkpoint_state is not None:
+            self.checkpoint.resume(checkpoint_state)
+            self.generated_dataset.resume = True
+        self.generated_dataset.checkpoint = self.checkpoint
         self.base_width, self.base_height = self.background_dataset.get_image_size()
         self.target_width, self.target_height = [
             int(x) for x in args.resolution.split('x')]
+        # Either render at the base resolution and scale the composite down,
+        # or render straight at the output resolution
+        self.render_width = self.base_width
+        self.render_height = self.base_height
+        if args.render_at_target:
+            self.render_width, self.render_height = thumbnail_size(
+                (self.base_width, self.base_height),
+                (self.target_width, self.target_height))
         self.sample_no = 0
         self.visible_gates = 0
+        self.buffers = {}
 
+    '''
+    Sets the world boundaries, and fails fast (before any worker is started)
+    when the gates can't be placed reliably within them
+    '''
     def set_world_parameters(self, boundaries):
         self.world_boundaries = boundaries
+        # The gates are placed around the origin, as in SceneRenderer
+        GatePlacer({
+            'x': boundaries['x'] / 2,
+            'y': boundaries['y'] / 2
+        }, self.min_dist).check_density(self.max_gates)
+
+    '''
+    Creates a SceneRenderer (and its OpenGL context)
+    '''
+    def create_projector(self):
+        return SceneRenderer(self.meshes_dir, self.render_width,
+                             self.render_height, self.world_boundaries,
+                             self.cam_param, self.extra_verbose,
+                             self.gl_backend)
+
+    '''
+    Returns the generator of a sample, derived from the seed and its index
+    only: a sample is the same whichever process generates it, and whichever
+    other samples are generated.
+    '''
+    def sample_rng(self, index):
+        return np.random.RandomState(derive_seed(self.seed, index))
+
+    '''
+    Yields the sample indices of the chunks left to generate
+    '''
+    def indices(self, chunks):
+        for start, stop in chunks:
+            for index in range(start, stop):
+                yield index
+
+    '''
+    Returns the chunks left to generate, or None (after saying so) when there
+    are none left
+    '''
+    def pending_chunks(self):
+        chunks = self.checkpoint.chunks()
+        if len(chunks) == 0:
+            print("[*] Nothing left to generate in {}".format(
+                self.generated_dataset.path))
+            return None
+        if self.generated_dataset.resume:
+            print("[*] Resuming: {} images left to generate".format(
+                sum(stop - start for start, stop in chunks)))
+
+        return chunks
 
     def run(self):
+        chunks = self.pending_chunks()
+        if chunks is None:
+            return
+        count = sum(stop - start for start, stop in chunks)
         print("[*] Generating dataset...")
         print("[*] Using {}x{} target resolution".format(self.target_width,
                                                          self.target_height))
-        save_thread = mp.threading.Thread(target=self.generated_dataset.save)
-        projector = SceneRenderer(self.meshes_dir, self.base_width,
-                                  self.base_height, self.world_boundaries,
-                                  self.cam_param, self.extra_verbose,
-                                  self.seed)
+        save_thread = Thread(target=self.generated_dataset.save)
+        projector = self.create_projector()
         save_thread.start()
-        for i in tqdm(range(self.count),
-                      unit="img",
-                      bar_format="{l_bar}{bar}|{n_fmt}/{total_fmt}"):
-            self.generate(i, projector)
+        try:
+            for sample in tqdm(
+                    self.generate_all(projector,
+                                      self.prefetch(self.indices(chunks))),
+                    total=count, unit="img",
+                    bar_format="{l_bar}{bar}|{n_fmt}/{total_fmt}"):
+                self.generated_dataset.put(sample)
+        finally:
+            # Let the saver flush what was generated, even on failure
+            self.generated_dataset.data.put(None)
+            save_thread.join()
+        stats = {
+            'samples': count,
+            'visible_gates': self.visible_gates,
+            'framebuffer_allocations_avoided':
+                projector.framebuffers.allocations_avoided
+        }
+        stats.update(self.generated_dataset.encoder.stats)
+        self.report(stats)
+        projector.destroy()
+        self.save_profile()
+
+    '''
+    Runs the generation in nb_threads worker processes, each one with its own
+    OpenGL context.
+    '''
+    def run_parallel(self):
+        chunks = self.pending_chunks()
+        if chunks is None:
+            return
+        print("[*] Generating dataset with {} processes...".format(
+            self.nb_threads))
+        print("[*] Using {}x{} target resolution".format(self.target_width,
+                                                         self.target_height))
+        # Compile the meshes once, rather than in each worker at once
+        MeshCache(self.meshes_dir).load()
+        engine = GenerationEngine(self, self.nb_threads)
+        self.report(engine.run(chunks))
+        self.save_profile()
+
+    '''
+    Streams count samples (the --count ones by default) from the worker
+    processes, without writing them: yields batches of (sample ids, RGB uint8
+    images of shape (batch, height, width, 3), annotations array of
+    ANNOTATION_DTYPE), in order. The batches are handed out to the workers as
+    they are consumed: at most nb_threads + prefetch of them are generated
+    ahead of the consumer. The samples are the ones a run with the same seed
+    writes.
+    '''
+    def iter_samples(self, batch_size=32, prefetch=2, count=None):
+        MeshCache(self.meshes_dir).load()
+        engine = GenerationEngine(self, max(1, self.nb_threads))
+        return engine.stream(self.count if count is None else count,
+                             batch_size, prefetch)
 
-        self.generated_dataset.data.put(None)
-        save_thread.join()
+    '''
+    Iterates over the given sample indices, with their background decoded
+    ahead of time.
+    '''
+    def prefetch(self, indices):
+        return BackgroundPrefetcher(self.background_dataset, indices,
+                                    max_bytes=self.prefetch_bytes,
+                                    profiler=self.profiler)
+
+    '''
+    Saves the trace of the profiled stages along with the dataset, and prints
+    their summary
+    '''
+    def save_profile(self):
+        if not self.profiler.enabled:
+            return
+        trace_path = os.path.join(self.generated_dataset.path, 'profile.json')
+        self.profiler.save_trace(trace_path)
+        print("[*] Saved the profile trace to {}".format(trace_path))
+        self.profiler.print_summary()
+
+    def report(self, stats):
         print("[*] Saved to {}".format(self.generated_dataset.path))
         print("[*] Gate visibilty percentage: {}%".format(
-            int((self.visible_gates/self.count)*100)))
+            int((stats['visible_gates']/stats['samples'])*100)))
+        print("[*] Framebuffer allocations avoided: {}".format(
+            stats['framebuffer_allocations_avoided']))
+        if stats.get('encoded_images', 0) > 0:
+            count = stats['encoded_images']
+            print("[*] Encoded {} {} images: {:.1f} ms/image, {:.1f} KB/image"
+                  .format(count, self.generated_dataset.encoder.format,
+                          1000 * stats['encode_time'] / count,
+                          stats['encoded_bytes'] / count / 1024))
 
     '''
-    FIXME: Memory leaks all over... Not easy to reuse a projector per thread.
+    Generates one sample, from its BackgroundImage and the decoded background
+    (RGB uint8 array), which is shared by the blur estimation and the
+    compositing.
     '''
-    def run_multi_threaded(self):
-        print("[*] Generating dataset...")
-        print("[*] Using {}x{} target resolution".format(self.target_width,
-                                                         self.target_height))
-        save_thread = mp.threading.Thread(target=self.generated_dataset.save)
-
-        with mp.Pool(self.nb_threads) as p:
-            max_ = self.count
-            with tqdm(total=max_) as pbar:
-                save_thread.start()
-                self.projectors = []
-                for i in range(self.nb_threads):
-                    self.projectors.append(
-                        SceneRenderer(self.meshes_dir, self.base_width,
-                                      self.base_height, self.world_boundaries,
-                                      self.cam_param, self.extra_verbose,
-                                      self.seed))
-                args = zip(range(max_), max_ * list(range(self.nb_threads)))
-                for i, _ in tqdm(
-                        enumerate(p.imap_unordered(self.generate, args))):
-                    pbar.update()
-                p.close()
-                p.join()
-                self.generated_dataset.data.put(None)
-                save_thread.join()
-                print("[*] Saved to {}".format(self.generated_dataset.path))
-                print("[*] Gate visibilty percentage: {}%".format(
-                    int((self.visible_gates/self.count)*100)))
-
-    def generate(self, index, projector):
-        background = self.background_dataset.get()
+    def generate(self, index, projector, background, image):
+        with self.profiler.span('sample', index=index):
+            return self.finish_sample(projector, *self.render_sample(
+                index, projector, background, image))
+
+    '''
+    Generates the samples of the given (index, BackgroundImage, decoded
+    background) tuples, in order. Each frame is rendered, and its readback
+    started, before the previous one is post-processed: the GPU renders and
+    transfers a frame while the CPU blurs, noises and composites the other.
+    '''
+    def generate_all(self, projector, backgrounds):
+        pending = None
+        for index, background, image in backgrounds:
+            rendered = self.render_sample(index, projector, background, image)
+            if pending is not None:
+                yield self.finish_sample(projector, *pending)
+            pending = rendered
+        if pending is not None:
+            yield self.finish_sample(projector, *pending)
+
+    '''
+    Renders the gates of a sample and starts reading the frame back. Returns
+    what finish_sample() needs to complete it.
+    '''
+    def render_sample(self, index, projector, background, image):
+        rng = self.sample_rng(index)
         projector.set_drone_pose(background.annotations)
-        projection, annotations = projector.generate(min_dist=self.min_dist,
-                                                     max_gates=self.max_gates)
+        blur_amount, noise_amount = None, 0.0
+        if self.gpu_post:
+            if not self.no_blur:
+                with self.profiler.span('blur_estimate', index=index):
+                    blur_amount = self.get_blur_amount(background, image)
+            noise_amount = self.noise_amount
+        with self.profiler.span('render', index=index):
+            annotations = projector.render(self.min_dist, self.max_gates, rng,
+                                           blur_amount, noise_amount)
+            readback = projector.start_readback()
+
+        return index, background, image, rng, annotations, readback
+
+    def finish_sample(self, projector, index, background, image, rng,
+                      annotations, readback):
+        profiler = self.profiler
+        # Waits for the GPU, if the frame isn't rendered and transferred yet
+        with profiler.span('readback', index=index):
+            projection = projector.finish_readback(readback)
         bboxes = annotations['bboxes']
         gate_visible = len(bboxes) > 0
 
         if gate_visible:
-            projection_blurred = self.apply_motion_blur(
-                projection, amount=self.get_blur_amount(background.image()))
-            projection_noised = self.add_noise(projection_blurred)
-            projection = projection_noised
+            if not self.gpu_post:
+                with profiler.span('blur_estimate', index=index):
+                    blur_amount = self.get_blur_amount(background, image)
+                with profiler.span('motion_blur', index=index):
+                    projection = self.apply_motion_blur(projection,
+                                                        amount=blur_amount)
+                with profiler.span('noise', index=index):
+                    projection = self.add_noise(projection, rng)
             self.visible_gates += 1
 
-        output = self.combine(projection, background.image())
+        projection_size = (projection.shape[1], projection.shape[0])
+        with profiler.span('combine', index=index):
+            output = self.combine(projection, image)
+        output_size = (output.shape[1], output.shape[0])
 
-        # TODO: Refactor (one-liner?)
-        scaled_bboxes = []
-        for bbox in bboxes:
-            scaled_bbox = bbox
-            for key, val in bbox.items():
-                if key in ['min', 'max']:
-                    scaled_bbox[key] = self.scale_coordinates(val, output.size)
-                elif key == 'normal' and bbox['class_id'] != 2:
-                    scaled_bbox[key]['origin'] = self.scale_coordinates(
-                        val['origin'], output.size)
-                    scaled_bbox[key]['end'] = self.scale_coordinates(
-                        val['end'], output.size)
-            scaled_bboxes.append(scaled_bbox)
+        scaled_bboxes = bboxes.copy()
+        for key in ['min', 'max', 'normal_origin', 'normal_end']:
+            scaled_bboxes[key] = self.scale_coordinates(
+                bboxes[key], projection_size, output_size)
 
         if self.verbose:
+            annotated_output = Image.fromarray(output)
             if gate_visible:
-                self.draw_bounding_boxes(output, scaled_bboxes,
+                self.draw_bounding_boxes(annotated_output, scaled_bboxes,
                                          annotations['closest_gate'])
-                self.draw_normals(output, scaled_bboxes)
+                self.draw_normals(annotated_output, scaled_bboxes)
 
-        if self.extra_verbose:
-            self.draw_image_annotations(output, annotations)
-
-        self.generated_dataset.put(
-            AnnotatedImage(
-                output,
-                index,
-                SyntheticAnnotations(scaled_bboxes)))
-
-    # Scale to target width/height
-    def scale_coordinates(self, coordinates, target_coordinates):
-        coordinates[0] = int(coordinates[0]
-                          * target_coordinates[0]
-                          / self.base_width)
-        coordinates[1] = int(coordinates[1]
-                          * target_coordinates[1]
-                          / self.base_height)
-
-        return coordinates
-
-    # NB: Thumbnail() only scales down!!
-    def combine(self, projection: Image, background: Image):
-        background = background.convert('RGBA')
-        if projection.size != (self.base_width, self.base_height):
-            projection.thumbnail(
-                (self.base_width, self.base_height),
-                Image.ANTIALIAS)
-        output = Image.alpha_composite(background, projection)
-        if output.size != (self.target_width, self.target_height):
-            output.thumbnail(
-                (self.target_width, self.target_height),
-                Image.ANTIALIAS)
-
-        return output
-
-    def get_blur_amount(self, img: Image):
-        gray_scale = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2GRAY)
-        variance_of_laplacian = cv2.Laplacian(gray_scale, cv2.CV_64F).var()
+            if self.extra_verbose:
+                self.draw_image_annotations(annotated_output, annotations)
+            output = np.array(annotated_output)
+
+        return AnnotatedImage(output, index,
+                              SyntheticAnnotations(scaled_bboxes))
+
+    # Scale an array of (x, y) coordinates from the rendered image's
+    # width/height to the target ones
+    def scale_coordinates(self, coordinates, source_size, target_size):
+        return np.trunc(coordinates * target_size / source_size)
+
+    '''
+    Returns a preallocated work buffer, reused from one sample to the next
+    '''
+    def buffer(self, name, shape, dtype=np.uint8):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+        return buf
+
+    '''
+    Alpha composites the RGBA projection over the RGB background, and scales
+    the result down to the target resolution (keeping the aspect ratio).
+    When rendering at the target resolution, the background is scaled down
+    (once) instead. Returns a new RGBA uint8 array.
+    '''
+    def combine(self, projection: np.ndarray, background: np.ndarray):
+        height, width = projection.shape[:2]
+        if background.shape[:2] != (height, width):
+            background = cv2.resize(
+                background, (width, height),
+                dst=self.buffer('background', (height, width, 3)),
+                interpolation=cv2.INTER_AREA)
+        alpha = self.buffer('alpha', (height, width, 1), np.float32)
+        np.multiply(projection[..., 3:], 1 / 255, out=alpha)
+        blended = self.buffer('blended', (height, width, 3), np.float32)
+        np.subtract(projection[..., :3], background, out=blended,
+                    dtype=np.float32)
+        blended *= alpha
+        blended += background
+        blended += 0.5
+        composite = self.buffer('composite', (height, width, 4))
+        np.copyto(composite[..., :3], blended, casting='unsafe')
+        composite[..., 3] = 255
+
+        size = thumbnail_size((width, height),
+                              (self.target_width, self.target_height))
+        if size != (width, height):
+            return cv2.resize(composite, size, interpolation=cv2.INTER_AREA)
+
+        return composite.copy()
+
+    '''
+    The blurrier the background, the stronger the motion blur. Its sharpness
+    is looked up in the index, and only computed for unindexed backgrounds.
+    '''
+    def get_blur_amount(self, background, img: np.ndarray):
+        variance_of_laplacian = self.sharpness_index.get(background.file, img)
         blur_amount = variance_of_laplacian / self.max_blur_amount
         if blur_amount > 1:
             blur_amount = 0.9
 
         return 1 - blur_amount
 
-    def add_noise(self, img):
-        noisy_img = random_noise(img, mode='gaussian',
-                                 var=self.noise_amount**2)
-        noisy_img = (255*noisy_img).astype(np.uint8)
-
-        return Image.fromarray(noisy_img)
-
-    def apply_motion_blur(self, img: Image, amount=0.5):
-        cv_img = np.array(img)
+    '''
+    Adds gaussian noise to the uint8 image, in place, from the noise bank
+    '''
+    def add_noise(self, img: np.ndarray, rng: np.random.RandomState):
+        return self.noise_bank.apply(img, rng)
 
+    '''
+    Blurs the uint8 image along its diagonal, into a preallocated buffer
+    '''
+    def apply_motion_blur(self, img: np.ndarray, amount=0.5):
         if self.no_blur:
-            return cv_img
-
-        if amount <= 0.3:
-            size = 3
-        elif amount <= 0.7:
-            size = 5
-        else:
-            size = 9
+            return img
+
+        size = motion_blur_kernel_size(amount)
         kernel = np.identity(size)
         kernel /= size
 
-        return cv2.filter2D(cv_img, -1, kernel)
+        return cv2.filter2D(img, -1, kernel,
+                            dst=self.buffer('blur', img.shape))
 
     def draw_bounding_boxes(self, img, bboxes, closest_gate, color="yellow",
                             closest_color="green"):
@@ -264,8 +511,8 @@ class DatasetFactory:
     def draw_normals(self, img, bboxes):
         for bbox in bboxes:
             if bbox['class_id'] != 2:
-                self.draw_gate_normal(img, bbox['normal']['origin'],
-                                      bbox['normal']['end'])
+                self.draw_gate_normal(img, bbox['normal_origin'],
+                                      bbox['normal_end'])
 
     def draw_gate_normal(self, img, center, normal_gt, color="red"):
         gate_draw = ImageDraw.Draw(img)
@@ -283,7 +530,31 @@ class DatasetFactory:
         text_draw.text((0, 0), text, color)
 
 
-if __name__ == "__main__":
+'''
+Builds the sharpness index of a background dataset, over all its annotated
+images
+'''
+def build_sharpness_index(argv):
+    parser = argparse.ArgumentParser(
+        prog='dataset_factory.py index',
+        description='Compute the sharpness (variance of the Laplacian) of \
+        each background image once, and save it alongside the dataset.')
+    parser.add_argument('dataset', help='the path to the background images \
+                        dataset', type=str)
+    parser.add_argument('-t', dest='threads', default=os.cpu_count(),
+                        type=int, help='the number of processes to use')
+    args = parser.parse_args(argv)
+
+    files = [os.path.join(args.dataset, file.decode('UTF-8'))
+             for file in BackgroundIndex(args.dataset).load()['file']]
+    index = SharpnessIndex(args.dataset)
+    index.load()
+    index.build(files, args.threads)
+    print("[*] Saved to {}".format(
+        os.path.join(args.dataset, SharpnessIndex.file_name)))
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='Generate a hybrid synthetic dataset of projections of a \
         given 3D model, in random positions and orientations, onto randomly \
@@ -301,7 +572,8 @@ if __name__ == "__main__":
     parser.add_argument('--res', dest='resolution', default='640x480',
                         type=str, help='the desired resolution (WxH)')
     parser.add_argument('-t', dest='threads', default=4, type=int,
-                        help='the number of threads to use')
+                        help='the number of worker processes to use (each\
+                        one with its own OpenGL context)')
     parser.add_argument('--camera', dest='camera_parameters', type=str,
                         help='the path to the camera parameters YAML file\
                         (output of OpenCV\'s calibration)',
@@ -319,15 +591,72 @@ if __name__ == "__main__":
                         type=float, help='the gaussian noise amount')
     parser.add_argument('--no-blur', dest='no_blur', action='store_true',
                         default=False, help='disable synthetic motion blur')
+    parser.add_argument('--gpu-post', dest='gpu_post', action='store_true',
+                        default=False, help='apply the motion blur and noise\
+                        on the GPU, before reading the frame back')
+    parser.add_argument('--render-at-target', dest='render_at_target',
+                        action='store_true', default=False, help='render\
+                        the gates at the target resolution rather than at\
+                        the base one')
+    parser.add_argument('--format', dest='image_format', default='png',
+                        choices=sorted(FORMATS), help='the output image\
+                        format (the WebP one is lossless)')
+    parser.add_argument('--compression', dest='compression', type=int,
+                        default=6, help='the PNG compression level (0-9)')
+    parser.add_argument('--quality', dest='quality', type=int, default=95,
+                        help='the JPEG quality (0-100)')
+    parser.add_argument('--encoders', dest='encoders', type=int, default=2,
+                        help='the number of image encoding threads (per\
+                        worker process)')
+    parser.add_argument('--shards', dest='shard_size', type=int, default=0,
+                        help='write shards of the given number of samples\
+                        (with an index) instead of an images directory')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        default=False, help='resume an interrupted run into\
+                        the same destination (with the same parameters)')
+    parser.add_argument('--gl-backend', dest='gl_backend', default=None,
+                        help='the OpenGL context backend (e.g. egl, for a\
+                        headless context)')
     parser.add_argument('--max-gates', dest='max_gates', type=int, help='the\
                         maximum amount of gates to spawn', default=6)
     parser.add_argument('--min-dist', dest='min_dist', type=float, help='the\
                         minimum distance between each gate, in meter',
                         default=3.5)
+    parser.add_argument('--sampling', dest='sampling', default='epochs',
+                        choices=['epochs', 'replacement'], help='use each\
+                        background once per epoch (reshuffled every epoch),\
+                        or pick them with replacement')
+    parser.add_argument('--weights', dest='weights', default=None, type=str,
+                        help='a CSV file of (file name, weight) lines, to\
+                        pick the backgrounds with (requires --sampling\
+                        replacement)')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int,
+                        default=1024, help='the maximum memory used by the\
+                        images in flight between the stages (decoded\
+                        backgrounds and generated samples), in MB')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        default=False, help='time each stage of the\
+                        generation, save a Chrome trace of the samples\
+                        (profile.json, in the destination folder) and print\
+                        a summary')
+    args = parser.parse_args(argv)
+    if args.weights is not None and args.sampling != 'replacement':
+        parser.error("--weights requires --sampling replacement")
+
+    return args
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        build_sharpness_index(sys.argv[2:])
+        sys.exit(0)
 
-    datasetFactory = DatasetFactory(parser.parse_args())
+    datasetFactory = DatasetFactory(parse_args())
     # Real world boundaries in meters (relative to the mesh's scale)
     datasetFactory.set_world_parameters(
         {'x': 10, 'y': 10},
     )
-    datasetFactory.run()
+    if datasetFactory.nb_threads > 1:
+        datasetFactory.run_parallel()
+    else:
+        datasetFactory.run()
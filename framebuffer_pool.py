@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+FramebufferPool
+
+Keeps the render targets of a ModernGL context alive between frames, so that
+they are only allocated once per (width, height, samples) configuration.
+"""
+
+from collections import OrderedDict
+
+
+class FramebufferPool:
+    def __init__(self, context, capacity=4):
+        self.context = context
+        self.capacity = capacity
+        self.framebuffers = OrderedDict()
+        self.allocations = 0
+        self.allocations_avoided = 0
+
+    '''
+    Returns a framebuffer with a color and a depth attachment of the given
+    size. The sample count is capped to what the driver supports.
+    The least recently used framebuffers are released once the pool is full,
+    which happens when the render size changes.
+    '''
+    def get(self, width: int, height: int, samples=0):
+        samples = min(samples, self.context.max_samples)
+        key = (width, height, samples)
+        if key in self.framebuffers:
+            self.framebuffers.move_to_end(key)
+            entry = self.framebuffers[key]
+            self.allocations_avoided += len(entry)
+            return entry['fbo']
+
+        while len(self.framebuffers) >= self.capacity:
+            self.release_entry(self.framebuffers.popitem(last=False)[1])
+
+        render_buffer = self.context.renderbuffer((width, height),
+                                                  samples=samples)
+        depth_render_buffer = self.context.depth_renderbuffer(
+            (width, height), samples=samples)
+        fbo = self.context.framebuffer(render_buffer,
+                                       depth_attachment=depth_render_buffer)
+        entry = {
+            'color': render_buffer,
+            'depth': depth_render_buffer,
+            'fbo': fbo
+        }
+        self.allocations += len(entry)
+        self.framebuffers[key] = entry
+
+        return fbo
+
+    def release_entry(self, entry):
+        entry['fbo'].release()
+        entry['color'].release()
+        entry['depth'].release()
+
+    def release(self):
+        for entry in self.framebuffers.values():
+            self.release_entry(entry)
+        self.framebuffers.clear()
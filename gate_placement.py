@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+GatePlacer
+
+Samples the gate poses of a frame: uniform translations inside the world
+boundaries, at least min_dist apart from each other, and random rotations
+around the Z-axis. A layout which runs out of attempts (its first gates left
+too little room for the others) is thrown away and sampled again.
+"""
+
+import numpy as np
+
+
+# Fraction of the area covered by disks placed at random one after the other,
+# until none fits anymore
+JAMMING_COVERAGE = 0.547
+
+
+class GatePlacer:
+    def __init__(self, boundaries, min_dist: float, attempts_per_gate=100,
+                 max_restarts=100):
+        self.boundaries = boundaries
+        self.min_dist = float(min_dist)
+        self.attempts_per_gate = attempts_per_gate
+        self.max_restarts = max_restarts
+        # At most one accepted gate per cell: any two points within a cell are
+        # at most min_dist apart, so they can't both be accepted
+        self.cell_size = self.min_dist / np.sqrt(2)
+        self.max_gates = self.compute_max_gates()
+
+    '''
+    Upper bound on the number of gates this sampler can place: random
+    sequential placement jams once disks of diameter min_dist cover about
+    JAMMING_COVERAGE of the area (grown by min_dist/2 on each side), far from
+    the density of a packing.
+    '''
+    def compute_max_gates(self):
+        if self.min_dist <= 0:
+            return np.inf
+        area = ((2 * self.boundaries['x'] + self.min_dist)
+                * (2 * self.boundaries['y'] + self.min_dist))
+        return int(JAMMING_COVERAGE * area / (np.pi * self.min_dist ** 2 / 4))
+
+    '''
+    Fails fast when the requested density can't be met reliably: beyond the
+    jamming bound, or when less than a quarter of a few trial layouts are
+    completed without a restart (a frame then fails with a probability below
+    (3/4)^(max_restarts + 1)).
+    '''
+    def check_density(self, count: int, trials=32):
+        success = 0
+        if count <= self.max_gates:
+            rng = np.random.RandomState(0)
+            success = sum(self.place(count, rng) is not None
+                          for _ in range(trials))
+        if success < trials / 4:
+            raise Exception("Cannot reliably place {} gates at least {}m "
+                            "apart within the {}x{}m world boundaries: lower "
+                            "--max-gates or --min-dist".format(
+                                count, self.min_dist,
+                                2 * self.boundaries['x'],
+                                2 * self.boundaries['y']))
+
+    '''
+    Returns the (count, 3) translations and the (count,) Z rotations (in
+    radians) of the gates. A layout which can't be completed is restarted
+    from scratch, at most max_restarts times.
+    '''
+    def sample(self, count: int, rng: np.random.RandomState):
+        for restart in range(self.max_restarts + 1):
+            translations = self.place(count, rng)
+            if translations is not None:
+                break
+        else:
+            raise Exception("Could not place {} gates at least {}m apart "
+                            "after {} restarts: lower --max-gates or "
+                            "--min-dist".format(count, self.min_dist,
+                                                self.max_restarts))
+        rotations = rng.random_sample(count) * np.pi
+
+        return translations, rotations
+
+    '''
+    Samples the translations of a layout, or returns None when it runs out of
+    attempts. Candidates are drawn in batches and accepted against a grid hash
+    of the previously accepted gates, so that the number of iterations is
+    bounded by count * attempts_per_gate.
+    '''
+    def place(self, count: int, rng: np.random.RandomState):
+        translations = np.zeros((count, 3))
+        grid = {}
+        placed = 0
+        attempts = 0
+        max_attempts = count * self.attempts_per_gate
+        while placed < count:
+            if attempts >= max_attempts:
+                return None
+            batch = min(4 * (count - placed), max_attempts - attempts)
+            candidates = np.column_stack([
+                rng.uniform(-self.boundaries['x'], self.boundaries['x'],
+                            batch),
+                rng.uniform(-self.boundaries['y'], self.boundaries['y'],
+                            batch)
+            ])
+            attempts += batch
+            for candidate in candidates:
+                if self.accept(candidate, grid, translations):
+                    translations[placed, :2] = candidate
+                    if self.cell_size > 0:
+                        grid[self.cell(candidate)] = placed
+                    placed += 1
+                    if placed == count:
+                        break
+
+        return translations
+
+    def cell(self, point):
+        return (int(np.floor(point[0] / self.cell_size)),
+                int(np.floor(point[1] / self.cell_size)))
+
+    '''
+    Checks the candidate against the accepted gates of the neighbouring cells
+    only (those within min_dist are at most 2 cells away).
+    '''
+    def accept(self, candidate, grid, translations):
+        if self.cell_size <= 0:
+            return True
+        cx, cy = self.cell(candidate)
+        for i in range(cx - 2, cx + 3):
+            for j in range(cy - 2, cy + 3):
+                neighbour = grid.get((i, j))
+                if (neighbour is not None
+                        and np.hypot(*(translations[neighbour, :2]
+                                       - candidate)) <= self.min_dist):
+                    return False
+
+        return True
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+GenerationEngine
+
+Spreads the dataset generation over worker processes. Each worker owns its
+own SceneRenderer (and thus its own standalone OpenGL context), pulls ranges
+of sample indices from a work queue, and writes the images itself (or
+encodes them, when writing shards). The records and the statistics are sent
+back to the parent process, which is the only one writing the annotations
+(or the shards).
+
+It can also stream the samples to the parent process in batches of NumPy
+arrays instead, without writing anything.
+"""
+
+import multiprocessing as mp
+import numpy as np
+import traceback
+import queue
+
+from itertools import chain, islice, repeat
+from tqdm import tqdm
+from memory_budget import ByteQueue
+
+
+# Approximate size of an annotation record (without its encoded image)
+RECORD_SIZE = 512
+
+
+'''
+Yields the sample indices of the ranges pulled from the work queue
+'''
+def _indices(tasks):
+    for start, stop in iter(tasks.get, None):
+        for index in range(start, stop):
+            yield index
+
+
+'''
+Entry point of the worker processes. The factory is inherited from the parent
+through fork(), so the background dataset does not have to be reloaded.
+'''
+def _worker(factory, tasks, results):
+    try:
+        # Each sample draws from its own generator, derived from its index
+        projector = factory.create_projector()
+        factory.visible_gates = 0
+        samples = factory.generate_all(projector,
+                                       factory.prefetch(_indices(tasks)))
+        # The encoding overlaps with the rendering of the next samples
+        count = 0
+        profiler = factory.profiler
+        for record in factory.generated_dataset.write_all(samples):
+            with profiler.span('queue_full:results'):
+                results.put(('record', record),
+                            RECORD_SIZE + len(record.get('data', b'')))
+            count += 1
+        factory.generated_dataset.encoder.close()
+        if profiler.enabled:
+            results.put(('profile', profiler.export()))
+        stats = {
+            'samples': count,
+            'visible_gates': factory.visible_gates,
+            'framebuffer_allocations_avoided':
+                projector.framebuffers.allocations_avoided
+        }
+        stats.update(factory.generated_dataset.encoder.stats)
+        results.put(('stats', stats))
+        projector.destroy()
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+'''
+Entry point of the worker processes streaming batches of samples: each range
+pulled from the work queue is a batch, generated and sent back before the
+next one is pulled.
+'''
+def _stream_worker(factory, tasks, results):
+    try:
+        projector = factory.create_projector()
+        dataset = factory.generated_dataset
+        for start, stop in iter(tasks.get, None):
+            images, annotations = None, []
+            for sample in factory.generate_all(
+                    projector, factory.prefetch(range(start, stop))):
+                if images is None:
+                    height, width = sample.image.shape[:2]
+                    images = np.empty((stop - start, height, width, 3),
+                                      np.uint8)
+                # The composite is opaque: only send its color channels
+                images[sample.id - start] = sample.image[..., :3]
+                annotations.append(dataset.annotation_array(
+                    sample, sample.id - start))
+            results.put(('batch', (start, np.arange(start, stop), images,
+                                   np.concatenate(annotations))))
+        results.put(('done', None))
+        projector.destroy()
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class GenerationEngine:
+    def __init__(self, factory, nb_workers: int):
+        self.factory = factory
+        self.nb_workers = nb_workers
+
+    '''
+    Generates the given (start, stop) chunks of samples and returns the
+    statistics merged over all the workers.
+    '''
+    def run(self, chunks):
+        # The workers rely on fork() to inherit the loaded background dataset,
+        # and must not inherit an OpenGL context: none is created in here.
+        context = mp.get_context('fork')
+        tasks = context.Queue()
+        # The records (and encoded images, when writing shards) waiting to be
+        # saved are bounded by their size
+        results = ByteQueue(self.factory.output_bytes, context)
+        count = sum(stop - start for start, stop in chunks)
+        for chunk in chunks:
+            tasks.put(chunk)
+        for _ in range(self.nb_workers):
+            tasks.put(None)
+
+        self.factory.generated_dataset.open()
+        workers = [
+            context.Process(target=_worker,
+                            args=(self.factory, tasks, results),
+                            daemon=True)
+            for _ in range(self.nb_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        stats = {}
+        finished = 0
+        profiler = self.factory.profiler
+        try:
+            with tqdm(total=count, unit="img",
+                      bar_format="{l_bar}{bar}|{n_fmt}/{total_fmt}") as pbar:
+                while finished < self.nb_workers:
+                    try:
+                        with profiler.span('queue_empty:results'):
+                            kind, payload = results.get(timeout=1)
+                    except queue.Empty:
+                        self.check_workers(workers)
+                        continue
+                    if kind == 'record':
+                        self.factory.generated_dataset.append(payload)
+                        pbar.update()
+                    elif kind == 'stats':
+                        for key, val in payload.items():
+                            stats[key] = stats.get(key, 0) + val
+                        finished += 1
+                    elif kind == 'profile':
+                        profiler.merge(payload)
+                    else:
+                        raise Exception(
+                            "A worker process failed:\n{}".format(payload))
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+        self.factory.generated_dataset.close()
+        return stats
+
+    '''
+    Generates the samples [0, count) and yields them in order, in batches of
+    (sample ids, RGB uint8 images of shape (batch, height, width, 3),
+    annotations array of ANNOTATION_DTYPE). The batches are handed out to the
+    workers on demand: at most nb_workers + prefetch of them are generated
+    ahead of the consumer.
+    '''
+    def stream(self, count: int, batch_size: int, prefetch: int):
+        context = mp.get_context('fork')
+        tasks = context.Queue()
+        results = context.Queue()
+        # The batch ranges, followed by a stop signal per worker
+        pending = chain(((start, min(start + batch_size, count))
+                         for start in range(0, count, batch_size)),
+                        repeat(None, self.nb_workers))
+        for task in islice(pending, self.nb_workers + max(0, prefetch)):
+            tasks.put(task)
+        workers = [
+            context.Process(target=_stream_worker,
+                            args=(self.factory, tasks, results),
+                            daemon=True)
+            for _ in range(self.nb_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # The batches completed ahead of the next one are held until then
+        completed = {}
+        next_batch = 0
+        finished = 0
+        try:
+            while next_batch < count:
+                if next_batch in completed:
+                    batch = completed.pop(next_batch)
+                    next_batch += batch_size
+                    for task in islice(pending, 1):
+                        tasks.put(task)
+                    yield batch
+                    continue
+                if finished == self.nb_workers:
+                    raise Exception("The workers exited before batch {}"
+                                    .format(next_batch))
+                try:
+                    kind, payload = results.get(timeout=1)
+                except queue.Empty:
+                    self.check_workers(workers)
+                    continue
+                if kind == 'batch':
+                    completed[payload[0]] = payload[1:]
+                elif kind == 'done':
+                    finished += 1
+                else:
+                    raise Exception(
+                        "A worker process failed:\n{}".format(payload))
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    '''
+    Raises if a worker died without reporting (e.g. killed by a signal).
+    '''
+    def check_workers(self, workers):
+        for worker in workers:
+            if not worker.is_alive() and worker.exitcode != 0:
+                raise Exception("Worker process {} exited with code {}".format(
+                    worker.pid, worker.exitcode))
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+ImageEncoder
+
+Encodes the generated images to PNG, JPEG or lossless WebP files, in a pool
+of threads (OpenCV releases the GIL while encoding), and keeps track of the
+encoding time and size.
+"""
+
+import numpy as np
+import threading
+import time
+import cv2
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+FORMATS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'webp': '.webp'
+}
+
+
+'''
+Syncs a file, or the entries of a directory (e.g. the files newly written to
+it), to disk
+'''
+def sync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ImageEncoder:
+    def __init__(self, format='png', workers=2, compression=6, quality=95):
+        if format not in FORMATS:
+            raise Exception("Unknown image format {} (expected one of {})"
+                            .format(format, ', '.join(FORMATS)))
+        self.format = format
+        self.extension = FORMATS[format]
+        self.workers = max(1, workers)
+        if format == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        elif format == 'jpeg':
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        else:
+            # A quality above 100 selects the lossless mode
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        # The pool is only started on the first submission, so that an encoder
+        # created before fork() gets its threads in the child process
+        self.pool = None
+        self.lock = threading.Lock()
+        self.stats = {
+            'encoded_images': 0,
+            'encode_time': 0.0,
+            'encoded_bytes': 0
+        }
+
+    '''
+    Encodes an RGBA uint8 image to the bytes of an image file. JPEG images
+    are stored without their alpha channel.
+    '''
+    def encode(self, img: np.ndarray):
+        start = time.perf_counter()
+        if self.format == 'jpeg':
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
+        else:
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA)
+        success, data = cv2.imencode(self.extension, img, self.params)
+        if not success:
+            raise Exception("Could not encode the image to {}".format(
+                self.format))
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.stats['encoded_images'] += 1
+            self.stats['encode_time'] += elapsed
+            self.stats['encoded_bytes'] += data.nbytes
+
+        return data
+
+    def write(self, img: np.ndarray, path: str):
+        data = self.encode(img)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def submit(self, fn, *args):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self.pool.submit(fn, *args)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
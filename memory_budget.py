@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+MemoryBudget / ByteQueue
+
+Bounds the items in flight between two stages of the generation by their
+size in bytes rather than by their number, so that the memory used does not
+depend on the resolution: the producer blocks (backpressure) until the
+consumer has released enough bytes.
+"""
+
+import threading
+import queue
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+
+
+'''
+Number of bytes held by the items in flight, bounded by max_bytes (unless it
+is 0). When given a multiprocessing context, the budget is shared by the
+processes forked after its creation.
+'''
+class MemoryBudget:
+    def __init__(self, max_bytes: int, context=None):
+        self.max_bytes = max(0, int(max_bytes))
+        if context is None:
+            self.condition = threading.Condition()
+            self.used = _Counter()
+        else:
+            self.condition = context.Condition()
+            self.used = context.Value('q', 0, lock=False)
+
+    '''
+    Blocks until size bytes fit in the budget. An item larger than the whole
+    budget is let through once nothing else is held, rather than blocking
+    forever.
+    '''
+    def acquire(self, size: int):
+        with self.condition:
+            while (self.max_bytes > 0 and self.used.value > 0
+                   and self.used.value + size > self.max_bytes):
+                self.condition.wait()
+            self.used.value += size
+
+    def release(self, size: int):
+        with self.condition:
+            self.used.value -= size
+            self.condition.notify_all()
+
+
+class ByteQueue:
+    def __init__(self, max_bytes: int, context=None):
+        self.budget = MemoryBudget(max_bytes, context)
+        self.queue = queue.Queue() if context is None else context.Queue()
+
+    '''
+    Puts an item of the given size (in bytes), once it fits in the budget
+    '''
+    def put(self, item, size=0):
+        self.budget.acquire(size)
+        self.queue.put((item, size))
+
+    def get(self, block=True, timeout=None):
+        item, size = self.queue.get(block, timeout)
+        self.budget.release(size)
+
+        return item
+
+    def task_done(self):
+        self.queue.task_done()
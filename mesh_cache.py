@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+MeshCache
+
+Compiles the meshes of a meshes directory (interleaved vx vy vz nx ny nz tx ty
+float32 vertices of the frame and contours) and their textures (flipped RGB
+pixels) once, into .npy files which are memory-mapped by every SceneRenderer:
+the OBJ and PNG files are not parsed again, and the processes share the pages.
+
+The compiled files are keyed by the hash of config.yaml and of every source
+file, so that they are rebuilt whenever one of them changes.
+"""
+
+import numpy as np
+import argparse
+import hashlib
+import shutil
+import yaml
+import json
+import os
+
+from ModernGL.ext.obj import Obj
+from PIL import Image
+
+
+# Bumped whenever the layout of the compiled files changes
+CACHE_VERSION = 1
+PARTS = ['frame', 'contour_back', 'contour_front']
+
+
+def file_hash(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class MeshCache:
+    cache_dir_name = '.cache'
+    manifest_name = 'manifest.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.cache_dir = os.path.join(path, self.cache_dir_name)
+
+    '''
+    Parses config.yaml, and returns the attributes of each mesh (in the
+    order of the directory listing) along with the source files they use
+    '''
+    def read_config(self):
+        try:
+            with open(os.path.join(self.path, "config.yaml"), "r") as config:
+                config_text = config.read()
+        except EnvironmentError as e:
+            print("[!] Could not load mesh attributes file:\
+                  {}".format(os.path.join(self.path, "config.yaml")))
+            raise EnvironmentError(e)
+        try:
+            mesh_attributes = yaml.safe_load(config_text)
+        except yaml.YAMLError as exc:
+            raise Exception(exc)
+
+        meshes = []
+        for file in os.listdir(self.path):
+            if (os.path.isfile(os.path.join(self.path, file))
+                    and file.endswith('_frame.obj')):
+                meshes.append((file, mesh_attributes[file]))
+
+        return config_text, meshes
+
+    '''
+    Key of the compiled meshes: the hash of the configuration and of all the
+    source files
+    '''
+    def key(self, config_text: str, meshes):
+        digest = hashlib.sha256("{}\n{}".format(
+            CACHE_VERSION, config_text).encode('UTF-8'))
+        for file, attributes in meshes:
+            for source in [file, attributes['contour_front'],
+                           attributes['contour_back'], attributes['texture']]:
+                digest.update("{}:{}\n".format(source, file_hash(
+                    os.path.join(self.path, source))).encode('UTF-8'))
+
+        return digest.hexdigest()[:16]
+
+    '''
+    Returns the compiled meshes, as a list of (file name, attributes, arrays)
+    where arrays holds the vertices of each part and the texture, memory-
+    mapped from the cache. They are compiled first if the cache is missing or
+    stale; when it cannot be written, they are compiled in memory.
+    '''
+    def load(self):
+        config_text, meshes = self.read_config()
+        entry_dir = os.path.join(self.cache_dir,
+                                 self.key(config_text, meshes))
+        if not os.path.isdir(entry_dir):
+            try:
+                self.build(meshes, entry_dir)
+            except OSError as e:
+                print("[!] Could not write the mesh cache ({}): compiling "
+                      "the meshes in memory".format(e))
+                return [(file, attributes, self.compile(file, attributes))
+                        for file, attributes in meshes]
+
+        with open(os.path.join(entry_dir, self.manifest_name), 'r',
+                  encoding='UTF-8') as f:
+            manifest = json.load(f)
+
+        return [(file, attributes, {
+            name: np.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+            for name, file_name in arrays.items()
+        }) for file, attributes, arrays in manifest['meshes']]
+
+    '''
+    Parses the OBJ files and the texture of a mesh
+    '''
+    def compile(self, file: str, attributes):
+        arrays = {}
+        sources = [file, attributes['contour_back'],
+                   attributes['contour_front']]
+        for part, source in zip(PARTS, sources):
+            obj = Obj.open(os.path.join(self.path, source))
+            arrays[part] = np.frombuffer(obj.pack('vx vy vz nx ny nz tx ty'),
+                                         dtype=np.float32).reshape(-1, 8)
+        with Image.open(os.path.join(self.path,
+                                     attributes['texture'])) as texture:
+            arrays['texture'] = np.asarray(
+                texture.transpose(Image.FLIP_LEFT_RIGHT).transpose(
+                    Image.FLIP_TOP_BOTTOM).convert('RGB'))
+
+        return arrays
+
+    '''
+    Compiles the meshes into a new cache entry, atomically (concurrent builds
+    of the same entry are harmless), and removes the stale entries
+    '''
+    def build(self, meshes, entry_dir: str):
+        print("[*] Compiling the meshes of {}...".format(self.path))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+        os.mkdir(tmp_dir)
+        manifest = []
+        for file, attributes in meshes:
+            arrays = {}
+            for name, array in self.compile(file, attributes).items():
+                arrays[name] = "{}.{}.npy".format(file, name)
+                np.save(os.path.join(tmp_dir, arrays[name]), array)
+            manifest.append((file, attributes, arrays))
+        with open(os.path.join(tmp_dir, self.manifest_name), 'w',
+                  encoding='UTF-8') as f:
+            json.dump({'version': CACHE_VERSION, 'meshes': manifest}, f,
+                      ensure_ascii=False, indent=4)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Built by another process in the meantime
+            shutil.rmtree(tmp_dir)
+            if not os.path.isdir(entry_dir):
+                raise
+        for entry in os.listdir(self.cache_dir):
+            if entry != os.path.basename(entry_dir) and '.tmp' not in entry:
+                shutil.rmtree(os.path.join(self.cache_dir, entry),
+                              ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compile the meshes of a meshes directory ahead of time')
+    parser.add_argument('meshes_dir', help='the 3D meshes directory', type=str)
+    args = parser.parse_args()
+    print("[*] {} meshes ready".format(len(MeshCache(args.meshes_dir).load())))
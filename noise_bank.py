@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+NoiseBank
+
+Gaussian noise tiles generated once at startup, and applied to each image
+with random offsets and flips in saturating integer arithmetic, instead of
+drawing fresh samples for every pixel of every image.
+"""
+
+import numpy as np
+
+
+class NoiseBank:
+    def __init__(self, amount: float, rng: np.random.RandomState,
+                 tile_size=128, nb_tiles=16, channels=4):
+        self.amount = amount
+        self.tile_size = tile_size
+        # Tiles are twice the block size, so that blocks can be cut at any
+        # offset. The samples are floored: adding them to integer pixels is
+        # then the same as truncating the float sum, as random_noise() did.
+        self.tiles = np.floor(rng.normal(
+            0, amount * 255, (nb_tiles, 2 * tile_size, 2 * tile_size,
+                              channels))).astype(np.int16)
+        self.noise = None
+
+    '''
+    Adds the noise to the (height, width, channels) uint8 image, in place.
+    Each block of tile_size pixels gets a random tile, offset and flips.
+    '''
+    def apply(self, img: np.ndarray, rng: np.random.RandomState):
+        if self.amount <= 0:
+            return img
+        if self.noise is None or self.noise.shape != img.shape:
+            self.noise = np.empty(img.shape, np.int16)
+        height, width = img.shape[:2]
+        size = self.tile_size
+        for y in range(0, height, size):
+            for x in range(0, width, size):
+                bh, bw = min(size, height - y), min(size, width - x)
+                tile = self.tiles[rng.randint(len(self.tiles))]
+                oy, ox = rng.randint(size + 1, size=2)
+                block = tile[oy:oy+bh, ox:ox+bw]
+                if rng.randint(2):
+                    block = block[::-1]
+                if rng.randint(2):
+                    block = block[:, ::-1]
+                self.noise[y:y+bh, x:x+bw] = block
+
+        self.noise += img
+        np.clip(self.noise, 0, 255, out=self.noise)
+        np.copyto(img, self.noise, casting='unsafe')
+
+        return img
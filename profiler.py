@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Profiler
+
+Low-overhead timers for the stages of the generation (and the time spent
+waiting on the queues between them), saved as a Chrome trace (to open in
+chrome://tracing or Perfetto) and summarized per stage.
+"""
+
+import numpy as np
+import threading
+import time
+import json
+import os
+
+from collections import OrderedDict
+
+
+class _Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start,
+                          time.perf_counter() - self.start, self.args)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    def __init__(self, enabled=False, max_events=500000):
+        self.enabled = enabled
+        # The trace is capped, the summary covers every span
+        self.max_events = max_events
+        self.events = []
+        self.durations = {}
+        self.threads = {}
+
+    '''
+    Times the enclosed block as a span of the given stage. Does nothing (but
+    return a shared object) when profiling is disabled.
+    '''
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def add(self, name: str, start: float, duration: float, args=None):
+        self.durations.setdefault(name, []).append(duration)
+        if len(self.events) < self.max_events:
+            thread = threading.current_thread()
+            key = (os.getpid(), thread.ident)
+            if key not in self.threads:
+                self.threads[key] = "{} ({})".format(thread.name, os.getpid())
+            self.events.append((name, start, duration, key[0], key[1],
+                                args or None))
+
+    '''
+    Returns what was recorded, to be merged into another process' profiler
+    '''
+    def export(self):
+        return {
+            'events': self.events,
+            'durations': self.durations,
+            'threads': list(self.threads.items())
+        }
+
+    def merge(self, profile):
+        for name, durations in profile['durations'].items():
+            self.durations.setdefault(name, []).extend(durations)
+        self.events.extend(
+            profile['events'][:self.max_events - len(self.events)])
+        self.threads.update(dict(profile['threads']))
+
+    '''
+    Saves the spans as Chrome trace events (timestamps in microseconds)
+    '''
+    def save_trace(self, path: str):
+        trace = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': name}
+        } for (pid, tid), name in self.threads.items()]
+        for name, start, duration, pid, tid, args in self.events:
+            event = {
+                'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': start * 1e6, 'dur': duration * 1e6
+            }
+            if args:
+                event['args'] = args
+            trace.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    '''
+    Number of spans, mean, p50, p99 and total time of each stage
+    '''
+    def summary(self):
+        summary = OrderedDict()
+        for name in sorted(self.durations):
+            durations = np.array(self.durations[name]) * 1000
+            summary[name] = OrderedDict([
+                ('count', len(durations)),
+                ('mean_ms', float(durations.mean())),
+                ('p50_ms', float(np.percentile(durations, 50))),
+                ('p99_ms', float(np.percentile(durations, 99))),
+                ('total_s', float(durations.sum() / 1000))
+            ])
+
+        return summary
+
+    def print_summary(self):
+        print("[*] Profile (queue_* spans are the time spent waiting on a "
+              "full or empty queue):")
+        print("    {:<24} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            'stage', 'count', 'mean (ms)', 'p50 (ms)', 'p99 (ms)',
+            'total (s)'))
+        for name, stats in self.summary().items():
+            print("    {:<24} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}"
+                  .format(name, stats['count'], stats['mean_ms'],
+                          stats['p50_ms'], stats['p99_ms'],
+                          stats['total_s']))
@@ -15,24 +15,58 @@ Generates an image by projecting a 3D mesh over a 2D transparent background.
 
 import numpy as np
 import moderngl
-import random
 import yaml
 import os
 
-from pyrr import Matrix33, Matrix44, Quaternion, Vector3, Vector4
-from ModernGL.ext.obj import Obj
-from PIL import Image
+from pyrr import Matrix33, Matrix44, Quaternion, Vector3
+from framebuffer_pool import FramebufferPool
+from gate_placement import GatePlacer
+from mesh_cache import MeshCache, PARTS
+
+
+'''
+Bounding box annotations of the visible gates of a frame, in image
+coordinates. The distance is NaN, and the normal is not set, for the gates
+seen from the back (class 2).
+'''
+BBOX_DTYPE = np.dtype([
+    ('class_id', 'i4'),
+    ('min', 'f8', 2),
+    ('max', 'f8', 2),
+    ('normal_origin', 'f8', 2),
+    ('normal_end', 'f8', 2),
+    ('distance', 'f8'),
+    ('rotation', 'f8')
+])
+
+
+'''
+Size of the diagonal motion blur kernel: the stronger the blur, the larger
+'''
+def motion_blur_kernel_size(amount: float):
+    if amount <= 0.3:
+        return 3
+    elif amount <= 0.7:
+        return 5
+
+    return 9
 
 
 class SceneRenderer:
     gl_version = (3, 3)
+    # Per-instance attributes: model matrix, frame color and light position
+    instance_format = '16f 3f 3f/i'
+    instance_dtype = np.dtype([('model', 'f4', 16), ('color', 'f4', 3),
+                               ('light', 'f4', 3)])
     def __init__(self, meshes_dir: str, width: int, height: int,
                  world_boundaries, camera_parameters, render_perspective=False,
-                 seed=None):
-        if seed:
-            random.seed(seed)
-        else:
-            random.seed()
+                 gl_backend=None):
+        self.placer = None
+        self.output_fbo = None
+        self.readbacks = []
+        self.next_readback = 0
+        self.gl_backend = gl_backend
+        self.post = None
         self.render_perspective = render_perspective
         self.width = width
         self.height = height
@@ -43,54 +77,81 @@ class SceneRenderer:
             except yaml.YAMLError as exc:
                 raise Exception(exc)
         self.setup_opengl()
+        self.program = self.load_shader_program('shader')
+        self.gate_program = self.load_shader_program('gate')
         self.meshes = self.load_meshes_and_textures(meshes_dir)
+        self.grid = None
+        if self.render_perspective:
+            self.grid = self.load_perspective_grid()
+
+    '''
+        Compiles a shader program once, for the whole lifetime of the
+        context. Only its uniforms change from one frame to another.
+    '''
+    def load_shader_program(self, name):
+        shaders_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'data')
+        with open(os.path.join(shaders_dir, name + '.vert')) as vert_file:
+            vertex_shader_source = vert_file.read()
+        with open(os.path.join(shaders_dir, name + '.frag')) as frag_file:
+            fragment_shader_source = frag_file.read()
+
+        return self.context.program(vertex_shader=vertex_shader_source,
+                                    fragment_shader=fragment_shader_source)
+
+    '''
+        Binds the packed mesh and the per-instance buffer to the instanced
+        gate program
+    '''
+    def load_instanced_vertex_array(self, vbo, instances):
+        return self.context.vertex_array(self.gate_program, [
+            (vbo, '3f 3f 2f', 'in_vert', 'in_norm', 'in_text'),
+            (instances, self.instance_format,
+             'in_model', 'in_color', 'in_light')
+        ])
+
+    '''
+        (Re)creates the per-instance buffer of a mesh and the vertex arrays
+        using it, so that it can hold at least the given number of gates
+    '''
+    def reserve_instances(self, mesh, count):
+        if mesh['instances'] is not None:
+            if mesh['instances'].size >= count * self.instance_dtype.itemsize:
+                return
+            for vao in mesh['vaos'].values():
+                vao.release()
+            mesh['instances'].release()
+
+        mesh['instances'] = self.context.buffer(
+            reserve=max(count, 8) * self.instance_dtype.itemsize,
+            dynamic=True)
+        mesh['vaos'] = {
+            part: self.load_instanced_vertex_array(vbo, mesh['instances'])
+            for part, vbo in mesh['buffers'].items()
+        }
 
+    '''
+        Uploads the meshes and textures, compiled once in the mesh cache
+    '''
     def load_meshes_and_textures(self, path):
         meshes = {}
-        mesh_attributes = {}
-        try:
-            with open(os.path.join(path, "config.yaml"), "r") as config:
-                try:
-                    mesh_attributes = yaml.safe_load(config)
-                except yaml.YAMLError as exc:
-                    raise Exception(exc)
-        except EnvironmentError as e:
-            print("[!] Could not load mesh attributes file:\
-                  {}".format(os.path.join(path, "config.yaml")))
-            raise EnvironmentError(e)
-
-        for file in os.listdir(path):
-            if os.path.isfile(os.path.join(path, file)):
-                if file.endswith('_frame.obj'):
-                    file_name = os.path.split(file)[-1]
-                    try:
-                        obj_file = Obj.open(os.path.join(path, file_name))
-                        contour_obj_front_file = Obj.open(
-                            os.path.join(path,
-                                         mesh_attributes[file_name]['contour_front']))
-                        contour_obj_back_file = Obj.open(
-                            os.path.join(path,
-                                         mesh_attributes[file_name]['contour_back']))
-                        contour_png = Image.open(
-                            os.path.join(
-                                path, mesh_attributes[file_name]['texture'])
-                        ).transpose(Image.FLIP_LEFT_RIGHT).transpose(
-                            Image.FLIP_TOP_BOTTOM).convert('RGB')
-                        contour_texture = self.context.texture(
-                            contour_png.size, 3, contour_png.tobytes())
-                        contour_texture.build_mipmaps()
-                    except Exception as e:
-                        raise Exception(e)
-
-                    meshes[file_name] = {
-                        'center': Vector3(mesh_attributes[file_name]['center']),
-                        'width': mesh_attributes[file_name]['width'],
-                        'height': mesh_attributes[file_name]['height'],
-                        'contour_obj_front': contour_obj_front_file,
-                        'contour_obj_back': contour_obj_back_file,
-                        'contour_texture': contour_texture,
-                        'obj': obj_file
-                    }
+        for file_name, attributes, arrays in MeshCache(path).load():
+            texture = arrays['texture']
+            contour_texture = self.context.texture(
+                (texture.shape[1], texture.shape[0]), 3, texture)
+            contour_texture.build_mipmaps()
+            meshes[file_name] = {
+                'center': Vector3(attributes['center']),
+                'width': attributes['width'],
+                'height': attributes['height'],
+                'contour_texture': contour_texture,
+                'buffers': {
+                    part: self.context.buffer(arrays[part]) for part in PARTS
+                },
+                'instances': None,
+                'vaos': {}
+            }
+            self.reserve_instances(meshes[file_name], 8)
 
         if len(meshes.items()) is 0:
             raise Exception("Meshes not loaded!")
@@ -105,10 +166,15 @@ class SceneRenderer:
 
     def set_drone_pose(self, drone_pose):
         self.drone_pose = drone_pose
-        self.gate_poses = []
 
     def setup_opengl(self):
-        self.context = moderngl.create_standalone_context()
+        # e.g. 'egl' for a headless context
+        if self.gl_backend:
+            self.context = moderngl.create_standalone_context(
+                backend=self.gl_backend)
+        else:
+            self.context = moderngl.create_standalone_context()
+        self.framebuffers = FramebufferPool(self.context)
         camera_intrinsics = [
             self.camera_parameters['camera_matrix']['data'][0:3],
             self.camera_parameters['camera_matrix']['data'][3:6],
@@ -116,6 +182,9 @@ class SceneRenderer:
         ]
         fx, fy = camera_intrinsics[0][0], camera_intrinsics[1][1]
         cx, cy = camera_intrinsics[0][2], camera_intrinsics[1][2]
+        # The projection only depends on the fx/cx and fy/cy ratios, which
+        # don't depend on the resolution: rendering at the target resolution
+        # rather than the base one needs no change of the intrinsics
         zfar, znear = 100.0, 0.1  # distances to the clipping plane
         self.projection = Matrix44([
             [fx/cx, 0, 0, 0],
@@ -123,152 +192,217 @@ class SceneRenderer:
             [0, 0, (-zfar - znear)/(zfar - znear), -1],
             [0, 0, (-2.0*zfar*znear)/(zfar - znear), 0]
         ])
+        # Rendered upside down, for the rows of the framebuffer to be stored
+        # top-down: the frames are read back as they are, without a flip
+        self.render_projection = self.projection.copy()
+        self.render_projection[1, 1] *= -1
 
     def destroy(self):
+        for mesh in self.meshes.values():
+            for vao in mesh['vaos'].values():
+                vao.release()
+            for vbo in mesh['buffers'].values():
+                vbo.release()
+            mesh['instances'].release()
+            mesh['contour_texture'].release()
+        if self.grid is not None:
+            self.grid['vao'].release()
+            self.grid['vbo'].release()
+        if self.post is not None:
+            self.post['vao'].release()
+            self.post['vbo'].release()
+            self.post['program'].release()
+            if self.post['texture'] is not None:
+                self.post['fbo'].release()
+                self.post['texture'].release()
+        for readback in self.readbacks:
+            readback['pbo'].release()
+        self.program.release()
+        self.gate_program.release()
+        self.framebuffers.release()
         self.context.release()
 
-    def render_gate(self, view, min_dist):
-        '''
-            Randomly move the gate around, while keeping it inside the
-            boundaries
-        '''
-        gate_translation = None
-        too_close = True
-        # Prevent gates from spawning too close to each other
-        while too_close:
-            too_close = False
-            gate_translation = Vector3([
-                random.uniform(-self.boundaries['x'], self.boundaries['x']),
-                random.uniform(-self.boundaries['y'], self.boundaries['y']),
-                0
-            ])
-            for gate_pose in self.gate_poses:
-                if (np.linalg.norm(gate_pose - gate_translation)
-                        <= float(min_dist)):
-                    too_close = True
-                    break
-
-        self.gate_poses.append(gate_translation)
-
-        ''' Randomly rotate the gate horizontally, around the Z-axis '''
-        gate_rotation = Quaternion.from_z_rotation(random.random() * np.pi)
-
-        model = Matrix44.from_translation(gate_translation) * gate_rotation
-        # With respect to the camera, for the annotation
-        gate_orientation = Matrix33(
-            self.drone_pose.orientation) * Matrix33(gate_rotation)
-        gate_orientation = Quaternion.from_matrix(gate_orientation)
-        # Model View Projection matrix
-        mvp = self.projection * view * model
-
-        # Shader program
-        vertex_shader_source = open('data/shader.vert').read()
-        fragment_shader_source = open('data/shader.frag').read()
-        prog = self.context.program(vertex_shader=vertex_shader_source,
-                                    fragment_shader=fragment_shader_source)
-
-        prog['Light1'].value = (
-            random.uniform(-self.boundaries['x'], self.boundaries['x']),
-            random.uniform(-self.boundaries['y'], self.boundaries['y']),
-            random.uniform(5, 7))
-        # prog['Light2'].value = (
-            # random.uniform(-self.boundaries['x'], self.boundaries['x']),
-            # random.uniform(-self.boundaries['y'], self.boundaries['y']),
-            # random.uniform(4, 7))
-        # prog['Light3'].value = (
-            # random.uniform(-self.boundaries['x'], self.boundaries['x']),
-            # random.uniform(-self.boundaries['y'], self.boundaries['y']),
-                # random.uniform(4, 7))
-            # prog['Light4'].value = (
-            # random.uniform(-self.boundaries['x'], self.boundaries['x']),
-            # random.uniform(-self.boundaries['y'], self.boundaries['y']),
-            # random.uniform(4, 7))
-        prog['MVP'].write(mvp.astype('f4').tobytes())
-
-        mesh = self.meshes[random.choice(list(self.meshes.keys()))]
-        frame_vbo = self.context.buffer(
-            mesh['obj'].pack('vx vy vz nx ny nz tx ty'))
-        frame_vao = self.context.simple_vertex_array(
-            prog, frame_vbo, 'in_vert', 'in_norm', 'in_text')
-        contour_front_vbo = self.context.buffer(
-            mesh['contour_obj_front'].pack('vx vy vz nx ny nz tx ty'))
-        contour_front_vao = self.context.simple_vertex_array(
-            prog, contour_front_vbo, 'in_vert', 'in_norm', 'in_text')
-        contour_back_vbo = self.context.buffer(
-            mesh['contour_obj_back'].pack('vx vy vz nx ny nz tx ty'))
-        contour_back_vao = self.context.simple_vertex_array(
-            prog, contour_back_vbo, 'in_vert', 'in_norm', 'in_text')
+    '''
+        Randomly move the gates around, while keeping them inside the
+        boundaries and apart from each other, and rotate them horizontally
+        around the Z-axis
+    '''
+    def place_gates(self, count, rng: np.random.RandomState):
+        translations, rotations = self.placer.sample(count, rng)
+
+        gates = []
+        for translation, angle in zip(translations, rotations):
+            gate_translation = Vector3(translation)
+            gate_rotation = Quaternion.from_z_rotation(angle)
+
+            model = Matrix44.from_translation(gate_translation) * gate_rotation
+            # With respect to the camera, for the annotation
+            gate_orientation = Matrix33(
+                self.drone_pose.orientation) * Matrix33(gate_rotation)
+            gate_orientation = Quaternion.from_matrix(gate_orientation)
+
+            light = (
+                rng.uniform(-self.boundaries['x'], self.boundaries['x']),
+                rng.uniform(-self.boundaries['y'], self.boundaries['y']),
+                rng.uniform(5, 7))
+            meshes = list(self.meshes.keys())
+            mesh = meshes[rng.randint(len(meshes))]
+            color = tuple(rng.uniform(0, 0.7, 3))
+
+            gates.append({
+                'mesh': mesh,
+                'model': model,
+                'translation': gate_translation,
+                'orientation': gate_orientation,
+                'light': light,
+                'color': color
+            })
+
+        return gates
 
+    '''
+        Draws all the gates of the frame: their model matrices, colors and
+        lights are uploaded as per-instance attributes, and each mesh part is
+        drawn with a single instanced call per mesh type.
+    '''
+    def render_gates(self, view, gates):
+        prog = self.gate_program
+        prog['VP'].write((self.render_projection * view).astype('f4')
+                         .tobytes())
         prog['viewPos'].value = (
             self.drone_pose.translation.x,
             self.drone_pose.translation.y,
             self.drone_pose.translation.z
         )
-        prog['Color'].value = (random.uniform(0, 0.7),
-                               random.uniform(0, 0.7),
-                               random.uniform(0, 0.7))
-        prog['UseTexture'].value = False
-        frame_vao.render()
-        prog['Color'].value = (0.8, 0.8, 0.8)
-        contour_back_vao.render()
-        mesh['contour_texture'].use()
-        prog['UseTexture'].value = True
-        contour_front_vao.render()
-
-        return mesh, model, gate_translation, gate_orientation
-
-    def project_to_img_frame(self, vector, viewMatrix):
-        clip_space_vector = self.projection * (
-            viewMatrix * Vector4.from_vector3(vector, w=1.0))
-        if clip_space_vector.w != 0:
-            nds_vector = Vector3(clip_space_vector.xyz) / clip_space_vector.w
-        else:  # Clipped
-            nds_vector = clip_space_vector.xyz
-
-        if nds_vector.z >= 1:
-            return [-1, -1]
-
-        viewOffset = 0
-        image_frame_vector =\
-            ((np.array(nds_vector.xy) + 1.0) /
-             2.0) * np.array([self.width, self.height]) + viewOffset
 
-        # Translate from bottom-left to top-left
-        image_frame_vector[1] = self.height - image_frame_vector[1]
-
-        return image_frame_vector
+        for name, mesh in self.meshes.items():
+            mesh_gates = [gate for gate in gates if gate['mesh'] == name]
+            if len(mesh_gates) == 0:
+                continue
+            instances = np.empty(len(mesh_gates), dtype=self.instance_dtype)
+            for i, gate in enumerate(mesh_gates):
+                instances[i]['model'] = np.ravel(gate['model'])
+                instances[i]['color'] = gate['color']
+                instances[i]['light'] = gate['light']
+            self.reserve_instances(mesh, len(instances))
+            mesh['instances'].write(instances.tobytes())
+
+            prog['UseTexture'].value = False
+            prog['UseInstanceColor'].value = True
+            mesh['vaos']['frame'].render(instances=len(instances))
+            prog['UseInstanceColor'].value = False
+            prog['Color'].value = (0.8, 0.8, 0.8)
+            mesh['vaos']['contour_back'].render(instances=len(instances))
+            mesh['contour_texture'].use()
+            prog['UseTexture'].value = True
+            mesh['vaos']['contour_front'].render(instances=len(instances))
 
     '''
-        Converting the gate normal's world coordinates to image coordinates
+        Projects homogeneous world coordinates of shape (N, 4) to image
+        coordinates of shape (N, 2), with a single matrix multiplication.
+        Points behind the camera are set to [-1, -1].
     '''
-    def compute_gate_normal(self, mesh, view, model):
-        gate_normal = model * (mesh['center'] + Vector3([0, 0.5, 0]))
-        return self.project_to_img_frame(gate_normal, view)
+    def project_to_img_frame(self, points, viewMatrix):
+        clip_space = points.dot(viewMatrix).dot(self.projection)
+        w = clip_space[:, 3:]
+        nds = np.where(w != 0, clip_space[:, :3] / np.where(w != 0, w, 1),
+                       clip_space[:, :3])
+
+        image_frame = (nds[:, :2] + 1.0) / 2.0 * [self.width, self.height]
+        # Translate from bottom-left to top-left
+        image_frame[:, 1] = self.height - image_frame[:, 1]
+        image_frame[nds[:, 2] >= 1] = -1
+
+        return image_frame
 
     '''
-        Converting the gate center's world coordinates to image coordinates
+        Computes the annotations of all the gates at once. The bounding box
+        corners, centers, normal endpoints and facing points of every gate are
+        stacked and transformed to world then image coordinates in one pass.
+        Bounding boxes are given as min/max (diagonal) corners in the image
+        frame, clipped to the image borders if one of them is outside, unless
+        the gate is not visible at all. Returns the structured array of the
+        visible gates' bounding boxes, and the index of the closest one.
     '''
-    def compute_gate_center(self, mesh, view, model):
-        # Return if the camera is within 0.6cm of the gate, because it's not
-        # visible
-        mesh_center = model * mesh['center']
-        if np.linalg.norm(mesh_center - self.drone_pose.translation) <= 0.6:
-            return [-1, -1]
-
-        return self.project_to_img_frame(mesh_center, view)
+    def compute_annotations(self, gates, view):
+        n = len(gates)
+        models = np.array([gate['model'] for gate in gates])
+        centers = np.array([self.meshes[gate['mesh']]['center']
+                            for gate in gates])
+        half_sizes = np.array([[self.meshes[gate['mesh']]['width'] / 2,
+                                self.meshes[gate['mesh']]['height'] / 2]
+                               for gate in gates])
+
+        # Model space points, per gate: top left, top right, bottom right,
+        # bottom left corners, center, normal end, leftmost and rightmost
+        # points (to know which side of the gate faces the camera)
+        offsets = np.array([[-1, 0, 1], [1, 0, 1], [1, 0, -1], [-1, 0, -1]])
+        points = np.ones((n, 8, 4))
+        points[:, :4, :3] = centers[:, None, :]
+        points[:, :4, 0] += offsets[:, 0] * half_sizes[:, None, 0]
+        points[:, :4, 2] += offsets[:, 2] * half_sizes[:, None, 1]
+        points[:, 4, :3] = centers
+        points[:, 5, :3] = centers + [0, 0.5, 0]
+        points[:, 6, :3] = centers * [1, 1, 0] - [20, 0, 0]
+        points[:, 7, :3] = centers * [1, 1, 0] + [20, 0, 0]
+        world = np.matmul(points, models)
+        world = world / world[:, :, 3:]
+
+        drone = np.array(self.drone_pose.translation)
+        left, right = world[:, 6, :3], world[:, 7, :3]
+        facing = np.cross(right - left, drone - left)[:, 2] >= 0
+        proximity = np.linalg.norm(world[:, 4, :3] - drone, axis=1)
+
+        img = self.project_to_img_frame(
+            world[:, :6].reshape(-1, 4), view).reshape(n, 6, 2)
+        corners = img[:, :4]
+        hidden_corners = np.sum(
+            (corners[..., 0] < 10) | (corners[..., 0] > (self.width - 10)) |
+            (corners[..., 1] < 10) | (corners[..., 1] > (self.height - 10)),
+            axis=1)
+        visible = hidden_corners <= 3
+        bbox_min = np.trunc(corners.min(axis=1))
+        bbox_max = np.trunc(corners.max(axis=1))
+        clipped = hidden_corners > 0
+        bounds = [self.width, self.height]
+        bbox_min[clipped] = np.clip(bbox_min[clipped], 0, bounds)
+        bbox_max[clipped] = np.clip(bbox_max[clipped], 0, bounds)
+
+        # The center isn't visible if the camera is within 0.6m of the gate
+        gate_center = img[:, 4]
+        gate_center[proximity <= 0.6] = -1
+
+        translations = np.array([gate['translation'] for gate in gates])
+        distance = np.linalg.norm(translations - drone, axis=1)
+        visible_gates = [gate for gate, v in zip(gates, visible) if v]
+        facing = facing[visible]
+
+        bboxes = np.zeros(len(visible_gates), dtype=BBOX_DTYPE)
+        bboxes['class_id'] = np.where(facing, 3, 2)
+        bboxes['min'] = bbox_min[visible]
+        bboxes['max'] = bbox_max[visible]
+        bboxes['normal_origin'] = np.where(facing[:, None],
+                                           gate_center[visible], np.nan)
+        bboxes['normal_end'] = np.where(facing[:, None], img[visible, 5],
+                                        np.nan)
+        bboxes['distance'] = np.where(facing, distance[visible], np.nan)
+        bboxes['rotation'] = [gate['orientation'].angle if front else 0.0
+                              for gate, front in zip(visible_gates, facing)]
+
+        # Pick the target gate: the closest facing one to the camera
+        closest_gate = None
+        if np.any(facing):
+            closest_gate = int(np.argmin(
+                np.where(facing, proximity[visible], np.inf)))
+            bboxes['class_id'][closest_gate] = 1
 
+        return bboxes, closest_gate
 
     '''
-        Project the perspective as a grid (might need some tuning for
+        Uploads the perspective grid once (might need some tuning for
         non-square environments)
     '''
-    def render_perspective_grid(self, view):
-        vertex_shader_source = open('data/shader.vert').read()
-        fragment_shader_source = open('data/shader.frag').read()
-        grid_prog = self.context.program(
-            vertex_shader=vertex_shader_source,
-            fragment_shader=fragment_shader_source)
-
+    def load_perspective_grid(self):
         grid = []
         x_length = int(self.boundaries['x'])
         for i in range(x_length * 2 + 1):
@@ -278,94 +412,89 @@ class SceneRenderer:
                          x_length, i - x_length, 0.0])
 
         grid = np.array(grid)
+        vbo = self.context.buffer(grid.astype('f4').tobytes())
+        vao = self.context.simple_vertex_array(self.program, vbo, 'in_vert')
+
+        return {'vbo': vbo, 'vao': vao, 'vertices': len(grid) * 2}
 
-        vp = self.projection * view
+    '''
+        Project the perspective as a grid
+    '''
+    def render_perspective_grid(self, view):
+        grid_prog = self.program
+        vp = self.render_projection * view
         grid_prog['Light1'].value = (0.0, 0.0, 3.0)
-        grid_prog['Light2'].value = (3.0, 0.0, 3.0)
-        grid_prog['Light3'].value = (-3.0, 0.0, 3.0)
-        grid_prog['Light4'].value = (0.0, 6.0, 3.0)
-        grid_prog['UseTexture'].value = False;
+        grid_prog['UseTexture'].value = False
         grid_prog['Color'].value = (0.0, 1.0, 0.0)
         grid_prog['MVP'].write(vp.astype('f4').tobytes())
 
-        vbo = self.context.buffer(grid.astype('f4').tobytes())
-        vao = self.context.simple_vertex_array(grid_prog, vbo, 'in_vert')
-
-        vao.render(moderngl.LINES, 65 * 4)
-        vao.release()
-
-    '''
-        Returns the Euclidean distance of the gate to the camera
-    '''
-    def compute_camera_proximity(self, model, mesh):
-        return np.linalg.norm((model * mesh['center']) - self.drone_pose.translation)
-
-    '''
-        Computes the bounding box min/max coordinates (diagonal corners) in the
-        image frame, and clips them to the image borders if one of them is
-        outside.  Otherwise, the gate is not visible.
-    '''
-    def compute_bbox_coords(self, model, mesh, view):
-        center = mesh['center']
-        world_corners = {
-            'top_left': model * Vector3([
-                center[0] - mesh['width']/2,
-                center[1],
-                center[2] + mesh['height']/2
-            ]),
-            'top_right': model * Vector3([
-                center[0] + mesh['width']/2,
-                center[1],
-                center[2] + mesh['height']/2
-            ]),
-            'bottom_right': model * Vector3([
-                center[0] + mesh['width']/2,
-                center[1],
-                center[2] - mesh['height']/2
-            ]),
-            'bottom_left': model * Vector3([
-                center[0] - mesh['width']/2,
-                center[1],
-                center[2] - mesh['height']/2
-            ])
-        }
-        hidden_corners = 0
-        left = right = top = bottom = None
-
-        for key, value in world_corners.items():
-            img_coords = self.project_to_img_frame(value, view)
-            if (img_coords[0] < 10 or img_coords[0] > (self.width-10)
-                    or img_coords[1] < 10 or img_coords[1] > (self.height-10)):
-                hidden_corners += 1
-            if left is None or (img_coords[0] < left['x']):
-                left = {'x': img_coords[0], 'y': img_coords[1]}
-            if top is None or (img_coords[1] < top['y']):
-                top = {'x': img_coords[0], 'y': img_coords[1]}
-            if bottom is None or (img_coords[1] > bottom['y']):
-                bottom = {'x': img_coords[0], 'y': img_coords[1]}
-            if right is None or (img_coords[0] > right['x']):
-                right = {'x': img_coords[0], 'y': img_coords[1]}
-
-        image_corners = {
-            'min': [int(left['x']), int(top['y'])],
-            'max': [int(right['x']), int(bottom['y'])]
-        }
+        self.grid['vao'].render(moderngl.LINES, self.grid['vertices'])
+
+    '''
+        Compiles the post-processing pass once: a full screen quad sampling
+        the resolved frame
+    '''
+    def load_post_pass(self):
+        program = self.load_shader_program('post')
+        vbo = self.context.buffer(np.array(
+            [-1.0, -1.0, 1.0, -1.0, -1.0, 1.0, 1.0, 1.0],
+            dtype='f4').tobytes())
+        vao = self.context.simple_vertex_array(program, vbo, 'in_vert')
 
-        if hidden_corners > 3:
-            return {}
-        elif hidden_corners > 0:
-            for key, img_coords in image_corners.items():
-                for i in range(0,2):
-                    if img_coords[i] < 0:
-                        img_coords[i] = 0
-                    elif img_coords[i] > (self.width if i == 0 else self.height):
-                        img_coords[i] = self.width if i == 0 else self.height
-                image_corners[key] = img_coords
+        return {'program': program, 'vbo': vbo, 'vao': vao, 'texture': None,
+                'fbo': None}
 
-        return image_corners
+    '''
+        Resolves the multisampled framebuffer into the final one through the
+        motion blur and noise pass, so that the frame is read back once
+        post-processed
+    '''
+    def post_process(self, fbo_src, fbo_dst, blur_amount, noise_amount, rng):
+        if self.post is None:
+            self.post = self.load_post_pass()
+        texture = self.post['texture']
+        if texture is None or texture.size != (self.width, self.height):
+            if texture is not None:
+                self.post['fbo'].release()
+                texture.release()
+            texture = self.post['texture'] = self.context.texture(
+                (self.width, self.height), 4)
+            self.post['fbo'] = self.context.framebuffer(texture)
+        # Multisampled framebuffers can only be resolved into framebuffers
+        self.context.copy_framebuffer(self.post['fbo'], fbo_src)
+
+        post_prog = self.post['program']
+        post_prog['KernelSize'].value = (
+            1 if blur_amount is None else motion_blur_kernel_size(blur_amount))
+        post_prog['NoiseStddev'].value = noise_amount * 255
+        post_prog['NoiseSeed'].value = int(rng.randint(2**32,
+                                                       dtype=np.uint64))
+        fbo_dst.use()
+        self.context.disable(moderngl.DEPTH_TEST)
+        texture.use(0)
+        self.post['vao'].render(moderngl.TRIANGLE_STRIP)
 
+    '''
+        Renders a frame of randomly placed gates, drawing from the given
+        generator only. The motion blur and noise are applied on the GPU when
+        a blur_amount or noise_amount is given (and a gate is visible),
+        instead of by the caller.
+    '''
+    def generate(self, min_dist=2.0, max_gates=6, rng=None, blur_amount=None,
+                 noise_amount=0.0):
+        annotations = self.render(min_dist, max_gates, rng, blur_amount,
+                                  noise_amount)
+
+        return (self.read_frame(), annotations)
 
-    def generate(self, min_dist=2.0, max_gates=6):
+    '''
+        Renders a frame into the output framebuffer (see generate()), and
+        returns its annotations
+    '''
+    def render(self, min_dist=2.0, max_gates=6, rng=None, blur_amount=None,
+               noise_amount=0.0):
+        if rng is None:
+            rng = np.random.RandomState()
         # Camera view matrix
         view = Matrix44.look_at(
             # eye: position of the camera in world coordinates
@@ -377,103 +506,80 @@ class SceneRenderer:
             self.drone_pose.orientation * Vector3([0.0, 0.0, 1.0])
         )
 
-        # Framebuffers
-        # Use 4 samples for MSAA anti-aliasing
-        msaa_render_buffer = self.context.renderbuffer((self.width,
-                                                        self.height),
-                                                       samples=8)
-        msaa_depth_render_buffer = self.context.depth_renderbuffer((self.width,
-                                                                    self.height),
-                                                                   samples=8)
-        fbo1 = self.context.framebuffer(
-            msaa_render_buffer,
-            depth_attachment=msaa_depth_render_buffer)
+        # Framebuffers, reused from one frame to the next
+        # Use 8 samples for MSAA anti-aliasing (or what the driver supports)
+        fbo1 = self.framebuffers.get(self.width, self.height, samples=8)
 
         # Downsample to the final framebuffer
-        render_buffer = self.context.renderbuffer((self.width, self.height))
-        depth_render_buffer = self.context.depth_renderbuffer((self.width, self.height))
-        fbo2 = self.context.framebuffer(render_buffer, depth_render_buffer)
+        fbo2 = self.output_fbo = self.framebuffers.get(self.width, self.height)
 
         # Rendering
         fbo1.use()
         self.context.enable(moderngl.DEPTH_TEST)
         self.context.clear(0, 0, 0, 0)
 
-        min_prox = None
-        bounding_boxes = []
-        closest_gate = None
-        n = 0
-        # Render at least one gate
-        for i in range(random.randint(1, max_gates)):
-            mesh, model, translation, rotation = self.render_gate(view, min_dist)
-            leftmost_point = model * Vector3(
-                [mesh['center'][0] - 20, mesh['center'][1], 0])
-            rightmost_point = model * Vector3(
-                [mesh['center'][0] + 20, mesh['center'][1], 0])
-            cross_product = (rightmost_point -
-                             leftmost_point).cross(self.drone_pose.translation -
-                                                   leftmost_point)
-            facing = True if cross_product.z >= 0 else False
-            proximity = self.compute_camera_proximity(model, mesh)
-            coords = self.compute_bbox_coords(model, mesh, view)
-
-            # Pick the target gate: the closest to the camera
-            if coords != {} and facing and (min_prox is None or proximity < min_prox):
-                closest_gate = n
-                min_prox = proximity
-
-            if coords != {}:
-                gate_rotation = Quaternion.from_z_rotation(0).angle
-                gate_normal = []
-                gate_center = []
-                gate_distance = None
-                if facing:
-                    gate_rotation = rotation.angle
-                    gate_distance = np.linalg.norm(self.drone_pose.translation - translation)
-                    gate_normal = self.compute_gate_normal(mesh, view, model)
-                    gate_center = self.compute_gate_center(mesh, view, model)
-
-                bounding_boxes.append({
-                    'class_id': 3 if facing else 2,
-                    'min': [coords['min'][0], coords['min'][1]],
-                    'max': [coords['max'][0], coords['max'][1]],
-                    'normal': {'origin': gate_center, 'end': gate_normal},
-                    'distance': gate_distance,
-                    'rotation': gate_rotation
-                })
-                n += 1
-
-        # Update the target gate's class
-        if closest_gate is not None:
-            bounding_boxes[closest_gate]['class_id'] = 1
+        if self.placer is None or self.placer.min_dist != float(min_dist):
+            self.placer = GatePlacer(self.boundaries, min_dist)
+
+        # Place at least one gate, and draw them all at once
+        gates = self.place_gates(rng.randint(1, max_gates + 1), rng)
+        self.render_gates(view, gates)
 
+        bounding_boxes, closest_gate = self.compute_annotations(gates, view)
 
         if self.render_perspective:
             self.render_perspective_grid(view)
 
-        self.context.copy_framebuffer(fbo2, fbo1)
-
-        # Loading the image using Pillow
-        img = Image.frombytes(
-            'RGBA', fbo2.size, fbo2.read(components=4, alignment=1), 'raw',
-            'RGBA', 0, -1)
+        if len(bounding_boxes) > 0 and (blur_amount is not None
+                                        or noise_amount > 0):
+            self.post_process(fbo1, fbo2, blur_amount, noise_amount, rng)
+        else:
+            self.context.copy_framebuffer(fbo2, fbo1)
 
-        annotations = {
+        return {
             'bboxes': bounding_boxes,
             'closest_gate': closest_gate,
             'drone_pose': self.drone_pose.translation,
             'drone_orientation': self.drone_pose.orientation
         }
 
-        '''
-        A soon-to-be-fixed bug in ModernGL forces me to release the render
-        buffers manually
-        '''
-        msaa_render_buffer.release()
-        msaa_depth_render_buffer.release()
-        render_buffer.release()
-        depth_render_buffer.release()
-        fbo1.release()
-        fbo2.release()
-
-        return (img, annotations)
+    '''
+        Ring of pixel buffers, and of the preallocated arrays the frames are
+        copied into from them
+    '''
+    def load_readback_ring(self, size=2):
+        return [{
+            'pbo': self.context.buffer(reserve=self.width * self.height * 4),
+            'frame': np.empty((self.height, self.width, 4), np.uint8)
+        } for _ in range(size)]
+
+    '''
+        Starts reading the last rendered frame back into the next pixel buffer
+        of the ring, without waiting for the GPU: the transfer overlaps with
+        whatever is done until finish_readback() is called.
+    '''
+    def start_readback(self):
+        if len(self.readbacks) == 0:
+            self.readbacks = self.load_readback_ring()
+        readback = self.readbacks[self.next_readback]
+        self.next_readback = (self.next_readback + 1) % len(self.readbacks)
+        self.output_fbo.read_into(readback['pbo'], components=4, alignment=1)
+
+        return readback
+
+    '''
+        Waits for a readback, and returns the frame as an RGBA uint8 array of
+        top-down rows. The array belongs to the ring: it is overwritten by the
+        readback started two frames later, and can be modified in place
+        until then.
+    '''
+    def finish_readback(self, readback):
+        readback['pbo'].read_into(readback['frame'])
+
+        return readback['frame']
+
+    '''
+        Reads the last rendered frame back (see finish_readback())
+    '''
+    def read_frame(self):
+        return self.finish_readback(self.start_readback())
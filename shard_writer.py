@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+ShardWriter / ShardReader
+
+Writes the generated samples to fixed-size shards of length-prefixed records
+(annotation record and encoded image), along with an index of their offsets,
+so that samples can be read in any order without listing directories.
+
+Each record is a little-endian (uint32, uint64) header holding the sizes of
+the UTF-8 JSON annotation record and of the image bytes which follow it.
+"""
+
+import numpy as np
+import argparse
+import shutil
+import struct
+import json
+import os
+
+from annotation_writer import CLASSES
+
+
+HEADER = struct.Struct('<IQ')
+INDEX_DTYPE = np.dtype([
+    ('id', 'u8'),
+    ('shard', 'u4'),
+    ('offset', 'u8'),
+    ('size', 'u8')
+])
+
+
+'''
+Id of a sample, from its image name ("%06d.<ext>")
+'''
+def sample_id(name: str):
+    return int(os.path.splitext(name)[0])
+
+
+class ShardWriter:
+    shards_dir_name = 'shards'
+    shard_name = "shard_%06d.rec"
+    index_name = 'index.npy'
+    manifest_name = 'manifest.json'
+
+    def __init__(self, path: str, shard_size=1000):
+        self.path = path
+        self.shards_dir = os.path.join(path, self.shards_dir_name)
+        self.shard_size = shard_size
+        self.shard = None
+        self.shard_no = 0
+        self.shard_count = 0
+
+    '''
+    Starts a new set of shards. A new run overwrites whatever a previous one
+    left behind, while a resumed one appends new shards to them.
+    '''
+    def open(self, resume=False):
+        if os.path.isdir(self.shards_dir):
+            if not resume:
+                shutil.rmtree(self.shards_dir)
+            else:
+                while os.path.isfile(os.path.join(
+                        self.shards_dir, self.shard_name % self.shard_no)):
+                    self.shard_no += 1
+                return
+        os.mkdir(self.shards_dir)
+
+    '''
+    Appends a record, whose 'data' entry holds the encoded image, to the
+    current shard
+    '''
+    def append(self, record):
+        record = dict(record)
+        data = record.pop('data')
+        meta = json.dumps(record, ensure_ascii=False).encode('UTF-8')
+        if self.shard is None:
+            self.shard = open(os.path.join(self.shards_dir,
+                                           self.shard_name % self.shard_no),
+                              'ab')
+        self.shard.write(HEADER.pack(len(meta), len(data)))
+        self.shard.write(meta)
+        self.shard.write(data)
+        self.shard_count += 1
+        if self.shard_count >= self.shard_size:
+            self.close_shard()
+            self.shard_no += 1
+            self.shard_count = 0
+
+    '''
+    Syncs the current shard to disk
+    '''
+    def flush(self):
+        if self.shard is not None:
+            self.shard.flush()
+            os.fsync(self.shard.fileno())
+
+    def close_shard(self):
+        if self.shard is not None:
+            self.shard.flush()
+            os.fsync(self.shard.fileno())
+            self.shard.close()
+            self.shard = None
+
+    def close(self):
+        self.close_shard()
+        self.build_index(self.path)
+
+    '''
+    Yields the (offset, size, record) of every complete record of a shard. A
+    truncated trailing record (interrupted write) is skipped.
+    '''
+    @classmethod
+    def scan_shard(cls, shard_path: str):
+        with open(shard_path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + HEADER.size <= end:
+                meta_size, data_size = HEADER.unpack(f.read(HEADER.size))
+                size = HEADER.size + meta_size + data_size
+                if offset + size > end:
+                    break
+                try:
+                    record = json.loads(f.read(meta_size).decode('UTF-8'))
+                except ValueError:
+                    break
+                yield offset, size, record
+                f.seek(data_size, os.SEEK_CUR)
+                offset += size
+
+    '''
+    Scans the shards (only reading the record headers) and writes the index
+    of the samples, sorted by id, along with the manifest. This also recovers
+    the shards left behind by an interrupted run.
+    '''
+    @classmethod
+    def build_index(cls, path: str):
+        shards_dir = os.path.join(path, cls.shards_dir_name)
+        entries = {}
+        shard_no = 0
+        while os.path.isfile(os.path.join(shards_dir,
+                                          cls.shard_name % shard_no)):
+            for offset, size, record in cls.scan_shard(
+                    os.path.join(shards_dir, cls.shard_name % shard_no)):
+                id = sample_id(record['image'])
+                entries[id] = (id, shard_no, offset, size)
+            shard_no += 1
+
+        index = np.array([entries[id] for id in sorted(entries)],
+                         dtype=INDEX_DTYPE)
+        np.save(os.path.join(shards_dir, cls.index_name), index)
+        with open(os.path.join(shards_dir, cls.manifest_name), 'w',
+                  encoding='UTF-8') as f:
+            json.dump({
+                'classes': CLASSES,
+                'shards': shard_no,
+                'samples': len(index)
+            }, f, ensure_ascii=False, indent=4)
+
+        return len(index)
+
+
+class ShardReader:
+    def __init__(self, path: str):
+        self.shards_dir = os.path.join(path, ShardWriter.shards_dir_name)
+        with open(os.path.join(self.shards_dir, ShardWriter.manifest_name),
+                  'r', encoding='UTF-8') as f:
+            self.manifest = json.load(f)
+        self.index = np.load(os.path.join(self.shards_dir,
+                                          ShardWriter.index_name),
+                             mmap_mode='r')
+        self.files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    '''
+    Returns the (record, image bytes) of the sample with the given id
+    '''
+    def __getitem__(self, id: int):
+        # Ids are contiguous unless samples are missing: only search then
+        position = id
+        if position >= len(self.index) or self.index['id'][position] != id:
+            position = int(np.searchsorted(self.index['id'], id))
+            if (position >= len(self.index)
+                    or self.index['id'][position] != id):
+                raise KeyError(id)
+        entry = self.index[position]
+        f = self.shard(int(entry['shard']))
+        f.seek(int(entry['offset']))
+
+        return self.read_record(f)
+
+    def shard(self, shard_no: int):
+        if shard_no not in self.files:
+            self.files[shard_no] = open(os.path.join(
+                self.shards_dir, ShardWriter.shard_name % shard_no), 'rb')
+        return self.files[shard_no]
+
+    def read_record(self, f):
+        meta_size, data_size = HEADER.unpack(f.read(HEADER.size))
+        record = json.loads(f.read(meta_size).decode('UTF-8'))
+
+        return record, f.read(data_size)
+
+    '''
+    Streams the (record, image bytes) of all the samples, one shard after the
+    other, in the order they were written
+    '''
+    def __iter__(self):
+        for position in np.lexsort((self.index['offset'],
+                                    self.index['shard'])):
+            entry = self.index[position]
+            f = self.shard(int(entry['shard']))
+            if f.tell() != entry['offset']:
+                f.seek(int(entry['offset']))
+            yield self.read_record(f)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Index the shards left behind by an interrupted run')
+    parser.add_argument('destination', metavar='dest', help='the path\
+                        to the generated dataset', type=str)
+    args = parser.parse_args()
+    print("[*] Indexed {} samples".format(
+        ShardWriter.build_index(args.destination)))
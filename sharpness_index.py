@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+SharpnessIndex
+
+Sidecar index of the variance of the Laplacian (sharpness) of each background
+image, keyed by file name, size and modification time, so that it is only
+computed once per background.
+"""
+
+import multiprocessing as mp
+import json
+import cv2
+import os
+
+from tqdm import tqdm
+from background_prefetcher import decode_image
+
+
+'''
+Sharpness of an RGB uint8 image: the variance of its Laplacian
+'''
+def variance_of_laplacian(img):
+    gray_scale = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.Laplacian(gray_scale, cv2.CV_64F).var()
+
+
+def _compute_entry(path: str):
+    stat = os.stat(path)
+    return (os.path.basename(path), stat.st_size, stat.st_mtime_ns,
+            variance_of_laplacian(decode_image(path)))
+
+
+class SharpnessIndex:
+    file_name = 'sharpness_index.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.checked = set()
+
+    def load(self):
+        index_path = os.path.join(self.path, self.file_name)
+        if not os.path.isfile(index_path):
+            return False
+        with open(index_path, 'r', encoding='UTF-8') as f:
+            self.entries = json.load(f)
+
+        return True
+
+    def save(self):
+        index_path = os.path.join(self.path, self.file_name)
+        with open(index_path + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump(self.entries, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    '''
+    Returns the entry of the given file if it is still up to date. The file
+    is only stat()'ed the first time it is looked up.
+    '''
+    def lookup(self, path: str):
+        name = os.path.basename(path)
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        if name not in self.checked:
+            stat = os.stat(path)
+            if entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+                del self.entries[name]
+                return None
+            self.checked.add(name)
+
+        return entry[2]
+
+    '''
+    Returns the sharpness of the given background, computing it from its
+    decoded image (and keeping it) if it isn't indexed.
+    '''
+    def get(self, path: str, img):
+        variance = self.lookup(path)
+        if variance is None:
+            stat = os.stat(path)
+            variance = variance_of_laplacian(img)
+            self.entries[os.path.basename(path)] = [
+                stat.st_size, stat.st_mtime_ns, variance]
+            self.checked.add(os.path.basename(path))
+
+        return variance
+
+    '''
+    Indexes the given files in nb_processes processes, skipping the ones
+    which are already up to date.
+    '''
+    def build(self, files, nb_processes: int):
+        files = [f for f in files if self.lookup(f) is None]
+        print("[*] Indexing {} background images...".format(len(files)))
+        with mp.Pool(nb_processes) as p:
+            for name, size, mtime, variance in tqdm(
+                    p.imap_unordered(_compute_entry, files, chunksize=16),
+                    total=len(files), unit="img"):
+                self.entries[name] = [size, mtime, variance]
+                self.checked.add(name)
+
+        self.save()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Theo Morales <theo.morales.fr@gmail.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Resume tests
+
+Interrupts a generation run partway (once some chunks are checkpointed), then
+resumes it, and checks that its annotations and images are those of an
+uninterrupted run.
+"""
+
+import subprocess
+import filecmp
+import signal
+import pytest
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip('moderngl')
+
+from benchmark import make_fixture
+
+
+COUNT = 120
+
+
+def factory_command(destination: str, fixture: str, *extra):
+    return [sys.executable, os.path.join(ROOT, 'dataset_factory.py'),
+            os.path.join(ROOT, 'meshes'), fixture, destination, '--camera',
+            os.path.join(ROOT, 'data', 'camera_calibration_params.yaml'),
+            '--count', str(COUNT), '--res', '320x240', '--format', 'jpeg',
+            '--gl-backend', os.environ.get('GL_BACKEND', 'egl'), '-t',
+            '1'] + list(extra)
+
+
+def completed_chunks(destination: str):
+    try:
+        with open(os.path.join(destination, 'checkpoint.json'), 'r') as f:
+            state = json.load(f)
+        return state['contiguous'] + len(state['completed'])
+    except (OSError, ValueError):
+        return 0
+
+
+def read_annotations(destination: str):
+    with open(os.path.join(destination, 'annotations.json'), 'r',
+              encoding='UTF-8') as f:
+        return json.load(f)['annotations']
+
+
+@pytest.fixture(scope='module')
+def fixture(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('backgrounds'))
+    make_fixture(path, 16, 320, 240)
+    return path
+
+
+@pytest.fixture(scope='module')
+def full_run(fixture, tmp_path_factory):
+    destination = str(tmp_path_factory.mktemp('full'))
+    subprocess.run(factory_command(destination, fixture, '--seed', '7'),
+                   check=True, stdout=subprocess.DEVNULL, timeout=600)
+    return destination
+
+
+'''
+Interrupts the run (with Ctrl-C, or killed without a chance to clean up and
+then recovered with annotation_writer.py) once some chunks are checkpointed
+but before it completes, and resumes it
+'''
+@pytest.mark.parametrize('sig', [signal.SIGINT, signal.SIGKILL],
+                         ids=['sigint', 'sigkill'])
+def test_resume_after_interruption(fixture, full_run, tmp_path, sig):
+    destination = str(tmp_path)
+    process = subprocess.Popen(factory_command(destination, fixture, '--seed',
+                                               '7'),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.time() + 600
+    while completed_chunks(destination) == 0 and process.poll() is None:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    process.send_signal(sig)
+    process.wait(timeout=600)
+    completed = completed_chunks(destination)
+    assert 0 < completed < (COUNT + 15) // 16, \
+        "The run wasn't interrupted partway"
+    if sig == signal.SIGKILL:
+        subprocess.run([sys.executable,
+                        os.path.join(ROOT, 'annotation_writer.py'),
+                        destination], check=True, stdout=subprocess.DEVNULL)
+
+    subprocess.run(factory_command(destination, fixture, '--resume'),
+                   check=True, stdout=subprocess.DEVNULL, timeout=600)
+
+    annotations = read_annotations(destination)
+    assert len(annotations) == COUNT
+    assert annotations == read_annotations(full_run)
+    images = sorted(os.listdir(os.path.join(full_run, 'images')))
+    assert sorted(os.listdir(os.path.join(destination, 'images'))) == images
+    _, mismatch, errors = filecmp.cmpfiles(
+        os.path.join(full_run, 'images'), os.path.join(destination, 'images'),
+        images, shallow=False)
+    assert mismatch == [] and errors == []